@@ -0,0 +1,124 @@
+import signal
+import asyncio
+import logging
+from functools import partial
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import BaseStorage
+from config import (
+    BOT_TOKEN, OPTIMIZE_IMAGES, RATE_LIMIT_ENABLED, RATE_LIMIT_GLOBAL, IMAGE_WORKERS, METRICS_ENABLED, METRICS_PORT,
+    WARMUP_CHAT_ID, WARMUP_CONCURRENCY,
+)
+from cards import (
+    CATALOGS, rescan_catalogs, watch_catalogs, get_all_cards, get_all_gift_cards, get_card_path, get_gift_card_path,
+)
+from image_pipeline import optimize_catalogs
+from media_cache import warm_up
+from storage import BoundedMemoryStorage, create_storage
+from ratelimit import rate_limiter
+from middlewares import CallbackDedupMiddleware, UserLockMiddleware
+from metrics import metrics, ApiMetricsMiddleware, instrument_dispatcher, start_metrics_server
+from database import get_write_queue
+from scheduler import scheduler
+from pagination import page_coalescer
+from handlers import start, name, request, dice, cards, discount, admin
+
+logger = logging.getLogger(__name__)
+
+
+def create_bot(global_rate: float = RATE_LIMIT_GLOBAL) -> Bot:
+    """Бот с ограничением исходящих запросов (global_rate — доля общего лимита для этого процесса)"""
+    bot = Bot(token=BOT_TOKEN)
+    if RATE_LIMIT_ENABLED:
+        # Все запросы к Bot API проходят через лимиты Telegram
+        rate_limiter.set_global_rate(global_rate)
+        bot.session.middleware(rate_limiter)
+    if METRICS_ENABLED:
+        bot.session.middleware(ApiMetricsMiddleware())
+    return bot
+
+
+def create_dispatcher(storage: BaseStorage = None) -> Dispatcher:
+    """Диспетчер с хранилищем FSM (по умолчанию из config.FSM_STORAGE) и всеми роутерами"""
+    dp = Dispatcher(storage=storage or create_storage())
+    if METRICS_ENABLED:
+        # Первым, чтобы в задержку обновления входило и ожидание своей очереди
+        instrument_dispatcher(dp)
+    # Сначала отбрасываются двойные нажатия, затем обновления пользователя выстраиваются в очередь
+    # (экземпляр сохраняется в диспетчере ради счетчика отброшенных нажатий в /metrics)
+    dp["callback_dedup"] = CallbackDedupMiddleware(exempt_prefixes=cards.PAGINATION_CALLBACK_PREFIXES)
+    dp.update.outer_middleware(dp["callback_dedup"])
+    dp.update.outer_middleware(UserLockMiddleware())
+    dp.include_router(start.router)
+    dp.include_router(name.router)
+    dp.include_router(request.router)
+    dp.include_router(dice.router)
+    dp.include_router(cards.router)
+    dp.include_router(discount.router)
+    dp.include_router(admin.router)
+    return dp
+
+
+async def prepare_catalogs(image_workers: int = IMAGE_WORKERS) -> asyncio.Task:
+    """Построение индекса карт и запуск фонового отслеживания папок"""
+    # Индекс карт строится один раз, дальше папки только отслеживаются в фоне
+    rescan_catalogs()
+    on_catalog_change = None
+    if OPTIMIZE_IMAGES:
+        # Оптимизированные копии готовятся до предзагрузки, чтобы в Telegram уходили уже они
+        await optimize_catalogs(CATALOGS, workers=image_workers)
+        on_catalog_change = partial(optimize_catalogs, CATALOGS, workers=image_workers)
+    return asyncio.create_task(watch_catalogs(on_change=on_catalog_change))
+
+
+async def warm_up_catalogs(bot: Bot):
+    """Предзагрузка всех карт в WARMUP_CHAT_ID (если задан); кэш file_id должен быть уже загружен"""
+    if not WARMUP_CHAT_ID:
+        return
+    paths = [get_card_path(card) for card in get_all_cards()]
+    paths += [get_gift_card_path(card) for card in get_all_gift_cards()]
+    await warm_up(bot, WARMUP_CHAT_ID, paths, concurrency=WARMUP_CONCURRENCY)
+
+
+async def run_until_terminated(coro):
+    """Выполнение coro до ее завершения или до SIGTERM.
+
+    По SIGTERM coro отменяется, а функция возвращается как обычно, чтобы вызывающий
+    выполнил ту же остановку, что и после Ctrl+C (сброс очереди записи, закрытие планировщика).
+    """
+    task = asyncio.create_task(coro)
+    terminated = False
+
+    def on_sigterm():
+        nonlocal terminated
+        logger.info("Получен SIGTERM, остановка")
+        terminated = True
+        task.cancel()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, on_sigterm)
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not terminated:
+            raise
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+
+
+async def start_metrics(dp: Dispatcher, port: int = METRICS_PORT):
+    """Запуск /metrics с показателями очередей и кэшей процесса; None, если метрики выключены"""
+    if not METRICS_ENABLED:
+        return None
+    metrics.gauge_callback("bot_write_queue_pending", lambda: get_write_queue().pending)
+    metrics.gauge_callback("bot_scheduler_pending", lambda: scheduler.pending)
+    if RATE_LIMIT_ENABLED:
+        metrics.gauge_callback("bot_send_queue_waiting", lambda: rate_limiter.waiting)
+    storage = dp.storage
+    if isinstance(storage, BoundedMemoryStorage):
+        metrics.gauge_callback("bot_fsm_sessions_resident", lambda: storage.resident)
+        metrics.gauge_callback("bot_fsm_sessions_evicted_total", lambda: storage.evictions, kind="counter")
+        metrics.gauge_callback("bot_fsm_sessions_expired_total", lambda: storage.expirations, kind="counter")
+    dedup = dp["callback_dedup"]
+    metrics.gauge_callback("bot_callbacks_deduplicated_total", lambda: dedup.dropped, kind="counter")
+    metrics.gauge_callback("bot_pages_coalesced_total", lambda: page_coalescer.coalesced, kind="counter")
+    return await start_metrics_server(port=port)
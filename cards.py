@@ -1,46 +1,280 @@
 import os
 import random
-from config import CARDS_DIR, GIFT_CARDS_DIR
+import hashlib
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple, Optional
+from config import CARDS_DIR, GIFT_CARDS_DIR, CARDS_WATCH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Расширения файлов, которые считаются картами
+CARD_EXTENSIONS = (".jpg", ".png", ".jpeg")
+
+# Сколько прошлых версий колоды помнить для пользователей, начавших выбор до изменения папки
+DECK_HISTORY = 16
+
+
+class CardEntry(NamedTuple):
+    """Карта в каталоге"""
+    name: str
+    path: str
+    size: int
+    mtime_ns: int
+    width: Optional[int]
+    height: Optional[int]
+    # Оптимизированная копия для отправки в Telegram (см. image_pipeline.py)
+    variant_path: Optional[str] = None
+
+    @property
+    def send_path(self) -> str:
+        """Путь к файлу, который отправляется пользователю"""
+        return self.variant_path or self.path
+
+
+def read_image_size(path: str):
+    """Размеры JPEG/PNG по заголовку файла, без декодирования изображения"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(26)
+            if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+                width, height = struct.unpack(">II", head[16:24])
+                return width, height
+            if head[:2] == b"\xff\xd8":
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        return None, None
+                    code = marker[1]
+                    if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                        continue
+                    (length,) = struct.unpack(">H", f.read(2))
+                    # SOF-маркеры (кроме DHT/JPG/DAC) содержат размеры кадра
+                    if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                        height, width = struct.unpack(">xHH", f.read(5))
+                        return width, height
+                    f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        pass
+    return None, None
+
+
+class CardCatalog:
+    """Индекс картинок одной папки.
+
+    Папка сканируется один раз, дальше обработчики получают список и пути из памяти.
+    rescan() обновляет индекс инкрементально: заново читаются только новые и измененные файлы.
+    Индекс неизменяемый и подменяется целиком.
+    Каждый состав карт — колода с идентификатором deck_id ("<key>:<version>"), на которую
+    ссылаются данные FSM пользователей вместо копии списка. version — хэш отсортированных имен,
+    поэтому одинаков в разных процессах и после перезапуска.
+    """
+
+    def __init__(self, directory: str, key: str):
+        self.directory = directory
+        self.key = key
+        self.version = ""
+        self._names = ()
+        self._entries = {}
+        self._by_path = {}
+        self._history = OrderedDict()
+        self._scanned = False
+
+    def rescan(self) -> bool:
+        """Пересканирование папки; возвращает True, если состав или файлы изменились"""
+        old_entries = self._entries
+        entries = {}
+        if os.path.isdir(self.directory):
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if not item.is_file() or not item.name.lower().endswith(CARD_EXTENSIONS):
+                        continue
+                    stat = item.stat()
+                    old = old_entries.get(item.name)
+                    if old is not None and old.mtime_ns == stat.st_mtime_ns and old.size == stat.st_size:
+                        entries[item.name] = old
+                        continue
+                    path = os.path.join(self.directory, item.name)
+                    width, height = read_image_size(path)
+                    entries[item.name] = CardEntry(item.name, path, stat.st_size, stat.st_mtime_ns, width, height)
+        
+        self._scanned = True
+        if entries == old_entries:
+            return False
+        self._publish(entries)
+        return True
+
+    def _publish(self, entries: dict):
+        # Сначала словари, потом список: имя из списка всегда найдется в словаре
+        self._entries = entries
+        self._by_path = {path: entry for entry in entries.values() for path in {entry.path, entry.send_path}}
+        names = tuple(sorted(entries))  # Сортируем для стабильности
+        if names != self._names or not self._history:
+            # Новая версия колоды только при изменении состава карт
+            self.version = deck_version(names)
+            self._history[self.version] = names
+            self._history.move_to_end(self.version)
+            while len(self._history) > DECK_HISTORY:
+                self._history.popitem(last=False)
+        self._names = names
+
+    def set_variant(self, entry: CardEntry, variant_path: str) -> bool:
+        """Подключение оптимизированной копии, если файл не менялся с момента ее подготовки"""
+        if self._entries.get(entry.name) != entry:
+            return False
+        entries = dict(self._entries)
+        entries[entry.name] = entry._replace(variant_path=variant_path)
+        self._publish(entries)
+        return True
+
+    def _ensure_scanned(self):
+        if not self._scanned:
+            self.rescan()
+
+    @property
+    def names(self) -> tuple:
+        """Отсортированные имена файлов карт"""
+        self._ensure_scanned()
+        return self._names
+
+    @property
+    def deck_id(self) -> str:
+        """Идентификатор текущей колоды"""
+        self._ensure_scanned()
+        return f"{self.key}:{self.version}"
+
+    def deck_names(self, version: str) -> Optional[tuple]:
+        """Имена карт колоды указанной версии (None, если версия уже забыта)"""
+        self._ensure_scanned()
+        return self._history.get(version)
+
+    def get(self, name: str) -> Optional[CardEntry]:
+        """Карта по имени файла"""
+        self._ensure_scanned()
+        return self._entries.get(name)
+
+    def get_by_path(self, path: str) -> Optional[CardEntry]:
+        """Карта по пути к исходнику или к оптимизированной копии"""
+        self._ensure_scanned()
+        return self._by_path.get(path)
+
+    def entries(self) -> list:
+        """Все карты в порядке имен"""
+        return [self.get(name) for name in self.names]
+
+    def __len__(self):
+        return len(self.names)
+
+
+card_catalog = CardCatalog(CARDS_DIR, "cards")
+gift_catalog = CardCatalog(GIFT_CARDS_DIR, "gift")
+CATALOGS = (card_catalog, gift_catalog)
+
+
+def deck_version(names: tuple) -> str:
+    """Версия колоды: хэш отсортированных имен карт"""
+    return hashlib.sha1("\n".join(names).encode("utf-8")).hexdigest()[:12]
+
+
+def _exclude(names: tuple, excluded: tuple) -> tuple:
+    if not excluded:
+        return names
+    return tuple(name for index, name in enumerate(names) if index not in excluded)
+
+
+@lru_cache(maxsize=256)
+def _resolve_known_deck(catalog: CardCatalog, version: str, excluded: tuple) -> tuple:
+    # Кэшируется только известная колода: состав карт версии не меняется никогда
+    return _exclude(catalog.deck_names(version), excluded)
+
+
+def resolve_deck(deck_id: str, excluded: tuple = ()) -> tuple:
+    """Имена карт колоды deck_id без карт с индексами из excluded.
+
+    Результат общий для всех пользователей с одинаковыми (deck_id, excluded).
+    Если версия колоды неизвестна (забыта или из старого формата), используется текущая колода
+    того же каталога; такой результат не кэшируется, чтобы он не пережил изменение папки.
+    """
+    if not deck_id:
+        return ()
+    key, _, version = deck_id.partition(":")
+    catalog = next((catalog for catalog in CATALOGS if catalog.key == key), None)
+    if catalog is None:
+        return ()
+    if catalog.deck_names(version) is None:
+        logger.warning(f"Колода {deck_id} устарела, используется текущая")
+        return _exclude(catalog.names, excluded)
+    return _resolve_known_deck(catalog, version, excluded)
+
+
+def get_entry_by_path(path: str) -> Optional[CardEntry]:
+    """Карта любого каталога по пути к файлу"""
+    for catalog in CATALOGS:
+        entry = catalog.get_by_path(path)
+        if entry is not None:
+            return entry
+    return None
+
+
+def rescan_catalogs() -> bool:
+    """Пересканирование всех каталогов карт; возвращает True, если что-то изменилось"""
+    changed = False
+    for catalog in CATALOGS:
+        if catalog.rescan():
+            changed = True
+            logger.info(f"Каталог {catalog.directory} обновлен: карт {len(catalog)}, версия {catalog.version}")
+    return changed
+
+
+async def watch_catalogs(interval: float = CARDS_WATCH_INTERVAL, on_change=None):
+    """Периодическая проверка папок с картами (сканирование выполняется в отдельном потоке).
+
+    on_change — необязательная корутина-функция, вызываемая после изменения каталогов.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await asyncio.to_thread(rescan_catalogs) and on_change is not None:
+                await on_change()
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении каталога карт: {e}")
 
 
 def get_all_cards():
     """Получение списка всех карт"""
-    if not os.path.exists(CARDS_DIR):
-        return []
-    
-    # Ищем все изображения в папке (jpg, png, jpeg)
-    cards = [f for f in os.listdir(CARDS_DIR) if f.lower().endswith((".jpg", ".png", ".jpeg"))]
-    return sorted(cards)  # Сортируем для стабильности
+    return list(card_catalog.names)
 
 
 def get_all_gift_cards():
     """Получение списка всех карт подарков"""
-    if not os.path.exists(GIFT_CARDS_DIR):
-        return []
-    
-    # Ищем все изображения в папке (jpg, png, jpeg)
-    cards = [f for f in os.listdir(GIFT_CARDS_DIR) if f.lower().endswith((".jpg", ".png", ".jpeg"))]
-    return sorted(cards)  # Сортируем для стабильности
+    return list(gift_catalog.names)
 
 
 def get_random_card():
     """Получение случайной карты"""
-    cards = get_all_cards()
+    cards = card_catalog.names
     if cards:
         return random.choice(cards)
     return None
 
 
 def get_card_path(card_filename):
-    """Получение полного пути к карте"""
+    """Получение пути к файлу карты для отправки (None, если такой карты нет в каталоге)"""
     if card_filename:
-        return os.path.join(CARDS_DIR, card_filename)
+        entry = card_catalog.get(card_filename)
+        if entry:
+            return entry.send_path
     return None
 
 
 def get_gift_card_path(card_filename):
-    """Получение полного пути к карте подарка"""
+    """Получение пути к файлу карты подарка для отправки (None, если такой карты нет в каталоге)"""
     if card_filename:
-        return os.path.join(GIFT_CARDS_DIR, card_filename)
+        entry = gift_catalog.get(card_filename)
+        if entry:
+            return entry.send_path
     return None
-
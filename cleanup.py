@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+logger = logging.getLogger(__name__)
+
+# Максимум сообщений в одном вызове deleteMessages
+DELETE_BATCH_SIZE = 100
+
+# Фоновые удаления: держим ссылки, чтобы задачи не собрал сборщик мусора
+_pending = set()
+
+
+async def delete_messages(bot: Bot, chat_id: int, message_ids) -> None:
+    """Удаление сообщений чата одним запросом deleteMessages.
+
+    Если массовое удаление не удалось, сообщения удаляются по одному параллельно;
+    ошибка одного удаления не мешает остальным.
+    """
+    message_ids = [message_id for message_id in dict.fromkeys(message_ids) if message_id]
+    if not message_ids:
+        return
+
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_BATCH_SIZE]
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+            continue
+        except TelegramAPIError as e:
+            logger.warning(f"Массовое удаление сообщений не удалось, удаляем по одному: {e}")
+
+        results = await asyncio.gather(
+            *(bot.delete_message(chat_id=chat_id, message_id=message_id) for message_id in batch),
+            return_exceptions=True
+        )
+        for message_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка при удалении сообщения {message_id}: {result}")
+
+
+def delete_messages_later(bot: Bot, chat_id: int, message_ids) -> None:
+    """Удаление сообщений в фоне, не задерживая ответ пользователю"""
+    task = asyncio.create_task(delete_messages(bot, chat_id, list(message_ids)))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+async def wait_pending() -> None:
+    """Ожидание фоновых удалений (при остановке бота)"""
+    if _pending:
+        await asyncio.gather(*_pending, return_exceptions=True)
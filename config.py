@@ -18,3 +18,87 @@ INSTAGRAM_ACCOUNT = os.getenv("INSTAGRAM_ACCOUNT", "@your_account")
 # База данных
 DATABASE_PATH = "bot_database.db"
 
+# Пул соединений с базой данных
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_WRITERS = int(os.getenv("DB_WRITERS", "1"))
+# Сколько миллисекунд ждать снятия блокировки SQLite
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "5000"))
+
+# Отложенная запись событий воронки и ответов
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.2"))
+# Сколько событий может ждать записи, прежде чем обработчики начнут ждать сброса
+WRITE_QUEUE_MAX = int(os.getenv("WRITE_QUEUE_MAX", "20000"))
+
+# Папка для выгрузок данных (/export и manage.py export)
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+
+# Предзагрузка картинок карт при запуске: служебный чат, куда бот отправляет каждую картинку один раз.
+# Если не задан, предзагрузка не выполняется
+WARMUP_CHAT_ID = int(os.getenv("WARMUP_CHAT_ID")) if os.getenv("WARMUP_CHAT_ID") else None
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+
+# Как часто (в секундах) проверять папки с картами на изменения
+CARDS_WATCH_INTERVAL = float(os.getenv("CARDS_WATCH_INTERVAL", "10"))
+
+# Оптимизированные копии картинок карт (нужен Pillow)
+OPTIMIZE_IMAGES = os.getenv("OPTIMIZE_IMAGES", "1") == "1"
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+# Telegram все равно уменьшает фото до 1280 пикселей по большей стороне
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# Количество процессов для обработки картинок (0 — по числу ядер)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0"))
+
+# Хранилище состояний FSM: bounded — в памяти с ограничением числа сессий,
+# memory — в памяти без ограничений, sqlite — в базе данных (переживает перезапуск)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "bounded")
+# Сколько сессий держать в кэше в памяти (sqlite)
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Максимум сессий в памяти (bounded): при превышении вытесняются самые давние
+FSM_MAX_SESSIONS = int(os.getenv("FSM_MAX_SESSIONS", "50000"))
+# Через сколько секунд бездействия сессия пользователя удаляется
+FSM_SESSION_TTL = int(os.getenv("FSM_SESSION_TTL", str(7 * 24 * 3600)))
+FSM_SWEEP_INTERVAL = int(os.getenv("FSM_SWEEP_INTERVAL", "600"))
+
+# Планировщик отложенных задач: сколько задач может выполняться одновременно
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "20"))
+# Напоминания (в секундах; 0 — не напоминать)
+REMINDER_CARD_DESCRIPTION_DELAY = int(os.getenv("REMINDER_CARD_DESCRIPTION_DELAY", "1800"))
+REMINDER_DISCOUNT_DELAY = int(os.getenv("REMINDER_DISCOUNT_DELAY", str(24 * 3600)))
+
+# Ограничение исходящих запросов к Telegram (лимиты Bot API)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))          # сообщений в секунду на бота
+RATE_LIMIT_CHAT = float(os.getenv("RATE_LIMIT_CHAT", "1"))              # сообщений в секунду в личный чат
+RATE_LIMIT_CHAT_BURST = int(os.getenv("RATE_LIMIT_CHAT_BURST", "3"))    # сколько можно отправить подряд без паузы
+RATE_LIMIT_GROUP = float(os.getenv("RATE_LIMIT_GROUP", "20"))           # сообщений в минуту в группу
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))  # повторов после RetryAfter
+
+# Способ получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, на который Telegram будет присылать обновления (например, https://bot.example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет в заголовке X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена бота
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Число рабочих процессов: 0 или 1 — один процесс; больше — процесс-распределитель принимает
+# обновления и передает их рабочим процессам по user_id
+WORKERS = int(os.getenv("WORKERS", "0"))
+# Через сколько секунд без признаков жизни рабочий процесс перезапускается
+WORKER_HEALTH_TIMEOUT = int(os.getenv("WORKER_HEALTH_TIMEOUT", "30"))
+
+# Повторное нажатие той же кнопки в течение стольких секунд игнорируется (0 — не игнорировать)
+CALLBACK_DEDUP_WINDOW = float(os.getenv("CALLBACK_DEDUP_WINDOW", "1.0"))
+
+# Пауза между правками сообщения при быстром перелистывании карт, с
+PAGINATION_DEBOUNCE = float(os.getenv("PAGINATION_DEBOUNCE", "0.25"))
+
+# Метрики задержек (Prometheus) на http://METRICS_HOST:METRICS_PORT/metrics; выключены по умолчанию
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# В режиме нескольких процессов рабочий процесс N слушает METRICS_PORT + N
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
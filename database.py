@@ -1,126 +1,484 @@
+import re
+import asyncio
+import logging
+import sqlite3
 import aiosqlite
-from datetime import datetime
-from config import DATABASE_PATH
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
+from migrations import apply_migrations, backfill_funnel_counters
+from metrics import timed_db
+from config import (
+    DATABASE_PATH, DB_READERS, DB_WRITERS, DB_BUSY_TIMEOUT,
+    WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_QUEUE_MAX,
+)
+
+logger = logging.getLogger(__name__)
+
+# Настройки, которые применяются к каждому соединению пула
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}",
+)
+# Наибольшая пауза между повторами записи пакета, когда БД занята, с
+FLUSH_RETRY_MAX_DELAY = 5
+# Сколько раз пытаться записать остаток буфера при остановке
+STOP_FLUSH_ATTEMPTS = 5
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений с SQLite: отдельно читатели и писатели"""
+
+    def __init__(self, path: str, readers: int = 1, writers: int = 1):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.writers_count = max(1, writers)
+        self._readers = asyncio.Queue()
+        self._writers = asyncio.Queue()
+        self._connections = []
+
+    async def open(self):
+        """Открытие всех соединений пула"""
+        # Писатели открываются первыми: они переводят файл в режим WAL
+        for _ in range(self.writers_count):
+            self._writers.put_nowait(await self._connect())
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect(read_only=True))
+
+    async def _connect(self, read_only: bool = False):
+        db = await aiosqlite.connect(self.path)
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        if read_only:
+            await db.execute("PRAGMA query_only = ON")
+        self._connections.append(db)
+        return db
+
+    @asynccontextmanager
+    async def reader(self):
+        """Соединение только для чтения"""
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Соединение для записи; при ошибке незавершенная транзакция откатывается"""
+        db = await self._writers.get()
+        try:
+            yield db
+        except BaseException:
+            if db.in_transaction:
+                await db.rollback()
+            raise
+        finally:
+            self._writers.put_nowait(db)
+
+    async def close(self):
+        """Закрытие всех соединений пула"""
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+
+
+@lru_cache(maxsize=None)
+def _statement_table(sql: str) -> str:
+    """Таблица, которую меняет запрос INSERT/UPDATE/DELETE"""
+    match = re.search(r"\b(?:INTO|FROM|UPDATE)\s+(\w+)", sql, re.IGNORECASE)
+    return match.group(1).lower() if match else sql
+
+
+def _group_statements(rows: list) -> list:
+    """Группировка запросов пакета для executemany с сохранением порядка.
+
+    Запрос присоединяется к более ранней группе с тем же SQL, только если после нее
+    в эту таблицу ничего не писалось: запросы к разным таблицам можно переставлять,
+    а INSERT и DELETE одной строки — нет.
+    """
+    groups = []
+    last_by_sql = {}
+    last_by_table = {}
+    for sql, params in rows:
+        table = _statement_table(sql)
+        index = last_by_sql.get(sql)
+        if index is not None and last_by_table.get(table) == index:
+            groups[index][1].append(params)
+            continue
+        groups.append((sql, [params]))
+        last_by_sql[sql] = last_by_table[table] = len(groups) - 1
+    return groups
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    """Временная ошибка: БД занята другим писателем (расширенные коды сводятся к основному)"""
+    code = getattr(error, "sqlite_errorcode", None)
+    return code is not None and code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+class WriteBehindQueue:
+    """Буфер отложенной записи: вставки копятся в памяти и сбрасываются одной транзакцией"""
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = 500, flush_interval: float = 0.2,
+                 max_pending: int = 20000):
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max(self.batch_size, max_pending)
+        self._rows = []
+        self._has_rows = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        """Количество событий, ожидающих записи"""
+        return len(self._rows)
+
+    def start(self):
+        """Запуск фоновой задачи сброса"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка фоновой задачи и запись всего, что осталось в буфере"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        delay = self.flush_interval
+        for attempt in range(1, STOP_FLUSH_ATTEMPTS + 1):
+            try:
+                await self.flush()
+                return
+            except aiosqlite.OperationalError as e:
+                if attempt == STOP_FLUSH_ATTEMPTS:
+                    logger.error(f"Не удалось записать пакет при остановке ({e}), потеряно записей: {len(self._rows)}")
+                    self._rows.clear()
+                    return
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, FLUSH_RETRY_MAX_DELAY)
+
+    async def put(self, sql: str, params: tuple):
+        """Постановка вставки в очередь; ждет только если буфер переполнен"""
+        await self.put_many([(sql, params)])
+
+    async def put_many(self, statements: list):
+        """Постановка нескольких запросов, которые обязательно попадут в одну транзакцию"""
+        while len(self._rows) >= self.max_pending:
+            # Обратное давление: обработчик ждет, пока фоновая задача освободит место
+            self._batch_ready.set()
+            await self._has_space.wait()
+        self.put_nowait(statements)
+
+    def put_nowait(self, statements: list):
+        """Постановка запросов без ожидания (для синхронного кода); предел очереди не проверяется"""
+        self._rows.extend(statements)
+        self._has_rows.set()
+        if len(self._rows) >= self.batch_size:
+            self._batch_ready.set()
+        if len(self._rows) >= self.max_pending:
+            self._has_space.clear()
+
+    def _requeue(self, rows: list):
+        # Пакет возвращается в начало буфера, чтобы порядок запросов не нарушился
+        self._rows[:0] = rows
+        self._has_rows.set()
+        if len(self._rows) >= self.max_pending:
+            self._has_space.clear()
+
+    @timed_db
+    async def flush(self):
+        """Запись всех накопленных вставок одной транзакцией.
+
+        Если БД занята (SQLITE_BUSY/SQLITE_LOCKED), пакет возвращается в буфер и ошибка пробрасывается,
+        чтобы вызывающий повторил запись позже; при остальных ошибках пакет отбрасывается.
+        """
+        async with self._flush_lock:
+            rows, self._rows = self._rows, []
+            self._has_rows.clear()
+            self._batch_ready.clear()
+            self._has_space.set()
+            if not rows:
+                return
+            try:
+                async with self.pool.writer() as db:
+                    for sql, params_list in _group_statements(rows):
+                        await db.executemany(sql, params_list)
+                    await db.commit()
+            except aiosqlite.OperationalError as e:
+                if not _is_busy(e):
+                    logger.exception(f"Ошибка при записи пакета событий, потеряно записей: {len(rows)}")
+                    return
+                self._requeue(rows)
+                raise
+            except Exception:
+                logger.exception(f"Ошибка при записи пакета событий, потеряно записей: {len(rows)}")
+
+    async def _run(self):
+        delay = 0
+        while True:
+            await self._has_rows.wait()
+            # Ждем, пока наберется пакет, но не дольше flush_interval
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                # shield: отмена при остановке не должна прерывать уже начатую транзакцию
+                await asyncio.shield(self.flush())
+                delay = 0
+            except aiosqlite.OperationalError as e:
+                delay = min(delay * 2 or self.flush_interval, FLUSH_RETRY_MAX_DELAY)
+                logger.warning(f"Не удалось записать пакет ({e}), повтор через {delay:.1f} с, в буфере: {len(self._rows)}")
+                await asyncio.sleep(delay)
+
+
+_pool = None
+_write_queue = None
+
+
+async def init_pool(path: str = DATABASE_PATH, readers: int = DB_READERS, writers: int = DB_WRITERS):
+    """Создание общего пула соединений и очереди записи (вызывается один раз при запуске)"""
+    global _pool, _write_queue
+    if _pool is None:
+        pool = ConnectionPool(path, readers=readers, writers=writers)
+        await pool.open()
+        _pool = pool
+        _write_queue = WriteBehindQueue(
+            pool,
+            batch_size=WRITE_BATCH_SIZE,
+            flush_interval=WRITE_FLUSH_INTERVAL,
+            max_pending=WRITE_QUEUE_MAX
+        )
+        _write_queue.start()
+        logger.info(f"Пул соединений с БД открыт: читателей={pool.readers_count}, писателей={pool.writers_count}")
+    return _pool
+
+
+async def close_pool():
+    """Сброс очереди записи и закрытие общего пула соединений"""
+    global _pool, _write_queue
+    if _write_queue is not None:
+        await _write_queue.stop()
+        _write_queue = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+        logger.info("Пул соединений с БД закрыт")
+
+
+def get_pool() -> ConnectionPool:
+    """Получение общего пула соединений"""
+    if _pool is None:
+        raise RuntimeError("Пул соединений с БД не инициализирован, сначала вызовите init_pool()")
+    return _pool
+
+
+def get_write_queue() -> WriteBehindQueue:
+    """Получение общей очереди отложенной записи"""
+    if _write_queue is None:
+        raise RuntimeError("Пул соединений с БД не инициализирован, сначала вызовите init_pool()")
+    return _write_queue
 
 
 async def init_db():
-    """Инициализация базы данных"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                name TEXT,
-                request TEXT,
-                dice_result INTEGER,
-                card_1 TEXT,
-                card_2 TEXT,
-                gift_card_1 TEXT,
-                gift_card_2 TEXT,
-                answers TEXT,
-                instagram_nick TEXT,
-                discount_claimed INTEGER DEFAULT 0,
-                created_at TEXT,
-                updated_at TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_answers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                question_number INTEGER,
-                answer TEXT,
-                created_at TEXT,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS funnel_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                step TEXT,
-                created_at TEXT,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        await db.commit()
+    """Инициализация базы данных: применение миграций схемы"""
+    async with get_pool().writer() as db:
+        version = await apply_migrations(db)
+    logger.info(f"Версия схемы БД: {version}")
+
+
+# Колонки users, которые разрешено записывать через save_user_data
+USER_COLUMNS = frozenset({
+    "username", "name", "request", "dice_result", "card_1", "card_2",
+    "gift_card_1", "gift_card_2", "answers", "instagram_nick", "discount_claimed",
+})
+
 
+@lru_cache(maxsize=None)
+def _user_upsert_sql(columns: tuple) -> str:
+    """Текст UPSERT-запроса для набора колонок (кэшируется для каждой комбинации)"""
+    fields = ", ".join(("user_id",) + columns + ("created_at", "updated_at"))
+    placeholders = ", ".join("?" for _ in range(len(columns) + 3))
+    updates = ", ".join([f"{column} = excluded.{column}" for column in columns] + ["updated_at = excluded.updated_at"])
+    return f"INSERT INTO users ({fields}) VALUES ({placeholders}) ON CONFLICT(user_id) DO UPDATE SET {updates}"
 
+
+@timed_db
 async def save_user_data(user_id: int, **kwargs):
-    """Сохранение данных пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        # Проверяем, существует ли пользователь
-        cursor = await db.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        exists = await cursor.fetchone()
-        
-        if exists:
-            # Обновляем существующего пользователя
-            fields = ", ".join([f"{k} = ?" for k in kwargs.keys()])
-            values = list(kwargs.values()) + [datetime.now().isoformat(), user_id]
-            await db.execute(f"UPDATE users SET {fields}, updated_at = ? WHERE user_id = ?", values)
-        else:
-            # Создаем нового пользователя
-            fields = ", ".join(kwargs.keys())
-            placeholders = ", ".join(["?" for _ in kwargs])
-            values = [user_id] + list(kwargs.values()) + [datetime.now().isoformat(), datetime.now().isoformat()]
-            await db.execute(
-                f"INSERT INTO users (user_id, {fields}, created_at, updated_at) VALUES (?, {placeholders}, ?, ?)",
-                values
-            )
+    """Сохранение данных пользователя (один запрос INSERT ... ON CONFLICT DO UPDATE)"""
+    unknown = kwargs.keys() - USER_COLUMNS
+    if unknown:
+        raise ValueError(f"Неизвестные поля пользователя: {', '.join(sorted(unknown))}")
+    
+    columns = tuple(sorted(kwargs))
+    now = datetime.now().isoformat()
+    values = (user_id,) + tuple(kwargs[column] for column in columns) + (now, now)
+    async with get_pool().writer() as db:
+        await db.execute(_user_upsert_sql(columns), values)
         await db.commit()
 
 
+@timed_db
 async def save_answer(user_id: int, question_number: int, answer: str):
-    """Сохранение ответа на вопрос"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
-            "INSERT INTO user_answers (user_id, question_number, answer, created_at) VALUES (?, ?, ?, ?)",
-            (user_id, question_number, answer, datetime.now().isoformat())
-        )
-        await db.commit()
+    """Сохранение ответа на вопрос (запись на диск выполняется пакетом в фоне)"""
+    await get_write_queue().put(
+        "INSERT INTO user_answers (user_id, question_number, answer, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, question_number, answer, datetime.now().isoformat())
+    )
 
 
+@timed_db
 async def log_funnel_step(user_id: int, step: str):
-    """Логирование шага воронки"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
-            "INSERT INTO funnel_stats (user_id, step, created_at) VALUES (?, ?, ?)",
-            (user_id, step, datetime.now().isoformat())
-        )
-        await db.commit()
+    """Логирование шага воронки (запись на диск выполняется пакетом в фоне)"""
+    created_at = datetime.now().isoformat()
+    day = created_at[:10]
+    # Событие и оба счетчика записываются в одной транзакции
+    await get_write_queue().put_many([
+        ("INSERT INTO funnel_stats (user_id, step, created_at) VALUES (?, ?, ?)", (user_id, step, created_at)),
+        (
+            "INSERT INTO funnel_counters (step, day, count) VALUES (?, ?, 1) "
+            "ON CONFLICT(step, day) DO UPDATE SET count = count + 1",
+            (step, day)
+        ),
+        (
+            "INSERT INTO funnel_totals (step, count) VALUES (?, 1) "
+            "ON CONFLICT(step) DO UPDATE SET count = count + 1",
+            (step,)
+        ),
+    ])
 
 
+@timed_db
 async def get_user_data(user_id: int):
     """Получение данных пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        if row:
-            columns = [description[0] for description in cursor.description]
-            return dict(zip(columns, row))
-        return None
+    async with get_pool().reader() as db:
+        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                columns = [description[0] for description in cursor.description]
+                return dict(zip(columns, row))
+            return None
 
 
+@timed_db
 async def get_all_users():
     """Получение всех пользователей (для админ-панели)"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT * FROM users ORDER BY created_at DESC")
-        rows = await cursor.fetchall()
-        columns = [description[0] for description in cursor.description]
-        return [dict(zip(columns, row)) for row in rows]
+    async with get_pool().reader() as db:
+        async with db.execute("SELECT * FROM users ORDER BY created_at DESC") as cursor:
+            rows = await cursor.fetchall()
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in rows]
 
 
+@timed_db
 async def get_funnel_stats():
-    """Получение статистики по воронке"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("""
-            SELECT step, COUNT(*) as count 
-            FROM funnel_stats 
-            GROUP BY step
-        """)
-        rows = await cursor.fetchall()
-        return {row[0]: row[1] for row in rows}
+    """Получение статистики по воронке (из счетчиков, без сканирования funnel_stats)"""
+    async with get_pool().reader() as db:
+        async with db.execute("SELECT step, count FROM funnel_totals") as cursor:
+            rows = await cursor.fetchall()
+            return {row[0]: row[1] for row in rows}
+
+
+@timed_db
+async def rebuild_funnel_counters():
+    """Пересчет счетчиков воронки по всей таблице funnel_stats (разовая операция)"""
+    async with get_pool().writer() as db:
+        # IMMEDIATE: никакой другой писатель не добавит события между очисткой и пересчетом
+        await db.execute("BEGIN IMMEDIATE")
+        await db.execute("DELETE FROM funnel_counters")
+        await db.execute("DELETE FROM funnel_totals")
+        await backfill_funnel_counters(db)
+        await db.commit()
+        async with db.execute("SELECT COALESCE(SUM(count), 0) FROM funnel_totals") as cursor:
+            (total,) = await cursor.fetchone()
+    return total
+
+
+@timed_db
+async def get_users_page(limit: int, cursor: tuple = None, backward: bool = False):
+    """Страница пользователей от новых к старым (keyset-пагинация по (created_at, user_id)).
+
+    cursor — (created_at, user_id) крайней записи текущей страницы; backward=True — предыдущая страница.
+    Возвращает список пользователей и признак того, что в этом направлении есть еще записи.
+    """
+    columns = "user_id, name, request, discount_claimed, created_at"
+    if cursor is None:
+        sql = f"SELECT {columns} FROM users ORDER BY created_at DESC, user_id DESC LIMIT ?"
+        params = (limit + 1,)
+    elif backward:
+        sql = (f"SELECT {columns} FROM users WHERE (created_at, user_id) > (?, ?) "
+               f"ORDER BY created_at ASC, user_id ASC LIMIT ?")
+        params = (cursor[0], cursor[1], limit + 1)
+    else:
+        sql = (f"SELECT {columns} FROM users WHERE (created_at, user_id) < (?, ?) "
+               f"ORDER BY created_at DESC, user_id DESC LIMIT ?")
+        params = (cursor[0], cursor[1], limit + 1)
+    
+    async with get_pool().reader() as db:
+        async with db.execute(sql, params) as db_cursor:
+            rows = await db_cursor.fetchall()
+            names = [description[0] for description in db_cursor.description]
+    
+    has_more = len(rows) > limit
+    users = [dict(zip(names, row)) for row in rows[:limit]]
+    if backward:
+        users.reverse()
+    return users, has_more
+
+
+@timed_db
+async def count_users() -> int:
+    """Общее количество пользователей"""
+    async with get_pool().reader() as db:
+        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+            (total,) = await cursor.fetchone()
+    return total
+
+
+@timed_db
+async def count_discount_claimed() -> int:
+    """Количество пользователей, получивших скидку"""
+    async with get_pool().reader() as db:
+        async with db.execute("SELECT COUNT(*) FROM users WHERE discount_claimed = 1") as cursor:
+            (total,) = await cursor.fetchone()
+    return total
+
+
+@timed_db
+async def get_signups_by_day(days: int = 7):
+    """Количество новых пользователей по дням за последние days дней (от новых к старым)"""
+    since = (datetime.now() - timedelta(days=days - 1)).date().isoformat()
+    async with get_pool().reader() as db:
+        async with db.execute("""
+            SELECT substr(created_at, 1, 10) AS day, COUNT(*)
+            FROM users
+            WHERE created_at >= ?
+            GROUP BY day
+            ORDER BY day DESC
+        """, (since,)) as cursor:
+            return await cursor.fetchall()
+
 
+@timed_db
+async def get_funnel_conversion():
+    """Шаги воронки: количество событий и их доля от всех пользователей в процентах"""
+    async with get_pool().reader() as db:
+        async with db.execute("""
+            SELECT t.step, t.count, ROUND(t.count * 100.0 / NULLIF(u.total, 0), 2)
+            FROM funnel_totals AS t, (SELECT COUNT(*) AS total FROM users) AS u
+            ORDER BY t.step
+        """) as cursor:
+            rows = await cursor.fetchall()
+    return [(step, count, percentage or 0) for step, count, percentage in rows]
@@ -0,0 +1,112 @@
+import asyncio
+import csv
+import gzip
+import json
+import os
+import uuid
+from datetime import date, datetime, timedelta
+from config import EXPORT_DIR
+from database import get_pool
+
+# Выгружаемые наборы данных: имя для команды -> таблица
+EXPORT_TABLES = {
+    "users": "users",
+    "answers": "user_answers",
+    "funnel": "funnel_stats",
+}
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+# Сколько строк читается из БД и записывается в файл за один шаг
+EXPORT_CHUNK_SIZE = 1000
+
+
+def parse_date(value: str) -> date:
+    """Разбор даты в формате ГГГГ-ММ-ДД"""
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Неверная дата: {value}, ожидается формат ГГГГ-ММ-ДД")
+
+
+def _build_query(table: str, date_from: date = None, date_to: date = None):
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append("created_at >= ?")
+        params.append(date_from.isoformat())
+    if date_to:
+        # Конечная дата включается целиком
+        conditions.append("created_at < ?")
+        params.append((date_to + timedelta(days=1)).isoformat())
+    
+    sql = f"SELECT * FROM {table}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql, params
+
+
+class _ExportWriter:
+    """Запись строк в сжатый CSV или JSONL файл"""
+
+    def __init__(self, path: str, fmt: str, columns: list):
+        self.file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self.fmt = fmt
+        self.columns = columns
+        if fmt == "csv":
+            self.csv_writer = csv.writer(self.file)
+            self.csv_writer.writerow(columns)
+
+    def write(self, rows: list):
+        if self.fmt == "csv":
+            self.csv_writer.writerows(rows)
+        else:
+            for row in rows:
+                self.file.write(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False))
+                self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+
+async def export_table(name: str, fmt: str = "csv", date_from: date = None, date_to: date = None,
+                       directory: str = EXPORT_DIR):
+    """Потоковая выгрузка таблицы в сжатый файл.
+
+    Строки читаются из БД порциями по EXPORT_CHUNK_SIZE и сразу пишутся на диск,
+    поэтому память не зависит от размера таблицы. Возвращает путь к файлу и число строк.
+    """
+    if name not in EXPORT_TABLES:
+        raise ValueError(f"Неизвестная таблица: {name}, доступны: {', '.join(EXPORT_TABLES)}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}, доступны: {', '.join(EXPORT_FORMATS)}")
+    
+    os.makedirs(directory, exist_ok=True)
+    # Суффикс uuid: две выгрузки в одну секунду не должны писать в один файл
+    filename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.{fmt}.gz"
+    path = os.path.join(directory, filename)
+    sql, params = _build_query(EXPORT_TABLES[name], date_from, date_to)
+    
+    total = 0
+    try:
+        async with get_pool().reader() as db:
+            async with db.execute(sql, params) as cursor:
+                columns = [description[0] for description in cursor.description]
+                writer = await asyncio.to_thread(_ExportWriter, path, fmt, columns)
+                try:
+                    while True:
+                        rows = await cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                        if not rows:
+                            break
+                        # Сжатие и запись на диск — в отдельном потоке, чтобы не блокировать бота
+                        await asyncio.to_thread(writer.write, rows)
+                        total += len(rows)
+                finally:
+                    await asyncio.to_thread(writer.close)
+    except BaseException:
+        # Недописанный файл не должен оставаться в папке выгрузок
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    
+    return path, total
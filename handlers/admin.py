@@ -1,10 +1,21 @@
+import os
+import logging
 from aiogram import Router, F
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.filters import Command
-from database import get_all_users, get_funnel_stats, get_user_data
-from config import ADMIN_IDS
+from database import (
+    get_funnel_stats, get_user_data, get_users_page,
+    count_users, count_discount_claimed, get_signups_by_day, get_funnel_conversion,
+)
+from export import EXPORT_TABLES, EXPORT_FORMATS, export_table, parse_date
+from config import ADMIN_IDS, RATE_LIMIT_ENABLED
+from ratelimit import rate_limiter
 
 router = Router()
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей показывать на одной странице /users
+USERS_PAGE_SIZE = 20
 
 
 @router.message(Command("admin"))
@@ -15,11 +26,11 @@ async def admin_panel(message: Message):
         return
     
     stats = await get_funnel_stats()
-    users = await get_all_users()
+    total_users = await count_users()
     
     text = f"""📊 Админ-панель
 
-👥 Всего пользователей: {len(users)}
+👥 Всего пользователей: {total_users}
 
 📈 Статистика по воронке:
 """
@@ -30,36 +41,87 @@ async def admin_panel(message: Message):
     text += "\nИспользуйте команды:\n"
     text += "/users - список всех пользователей\n"
     text += "/stats - детальная статистика\n"
-    text += "/user <user_id> - данные конкретного пользователя"
+    text += "/user <user_id> - данные конкретного пользователя\n"
+    text += "/export <users|answers|funnel> [csv|jsonl] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] - выгрузка в файл"
     
     await message.answer(text)
 
 
+def format_users_page(users: list) -> str:
+    """Текст страницы списка пользователей"""
+    text = "👥 Список пользователей:\n\n"
+    for user in users:
+        text += f"ID: {user['user_id']}\n"
+        text += f"Имя: {user.get('name') or 'Не указано'}\n"
+        text += f"Запрос: {(user.get('request') or 'Не указано')[:50]}...\n"
+        text += f"Скидка: {'Да' if user.get('discount_claimed') else 'Нет'}\n"
+        text += f"Дата: {user.get('created_at') or 'Неизвестно'}\n\n"
+    return text
+
+
+def users_page_keyboard(users: list, has_prev: bool, has_next: bool):
+    """Кнопки перехода между страницами; курсор — (created_at, user_id) крайней записи"""
+    buttons = []
+    if has_prev:
+        first = users[0]
+        buttons.append(InlineKeyboardButton(
+            text="◀️ Назад",
+            callback_data=f"users_prev|{first['created_at']}|{first['user_id']}"
+        ))
+    if has_next:
+        last = users[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Далее ▶️",
+            callback_data=f"users_next|{last['created_at']}|{last['user_id']}"
+        ))
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
 @router.message(Command("users"))
 async def list_users(message: Message):
-    """Список всех пользователей"""
+    """Список пользователей (первая страница)"""
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("У вас нет доступа к админ-панели.")
         return
     
-    users = await get_all_users()
+    users, has_next = await get_users_page(USERS_PAGE_SIZE)
     
     if not users:
         await message.answer("Пользователей пока нет.")
         return
     
-    text = "👥 Список пользователей:\n\n"
-    for user in users[:20]:  # Показываем первые 20
-        text += f"ID: {user['user_id']}\n"
-        text += f"Имя: {user.get('name', 'Не указано')}\n"
-        text += f"Запрос: {user.get('request', 'Не указано')[:50]}...\n"
-        text += f"Скидка: {'Да' if user.get('discount_claimed') else 'Нет'}\n"
-        text += f"Дата: {user.get('created_at', 'Неизвестно')}\n\n"
+    keyboard = users_page_keyboard(users, has_prev=False, has_next=has_next)
+    await message.answer(format_users_page(users), reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith("users_prev|") | F.data.startswith("users_next|"))
+async def list_users_page(callback: CallbackQuery):
+    """Переход на соседнюю страницу списка пользователей"""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа к админ-панели.", show_alert=True)
+        return
     
-    if len(users) > 20:
-        text += f"... и ещё {len(users) - 20} пользователей"
+    try:
+        direction, created_at, user_id = callback.data.split("|")
+        cursor = (created_at, int(user_id))
+    except ValueError:
+        await callback.answer()
+        return
     
-    await message.answer(text)
+    backward = direction == "users_prev"
+    users, has_more = await get_users_page(USERS_PAGE_SIZE, cursor=cursor, backward=backward)
+    await callback.answer()
+    
+    if not users:
+        return
+    
+    if backward:
+        keyboard = users_page_keyboard(users, has_prev=has_more, has_next=True)
+    else:
+        keyboard = users_page_keyboard(users, has_prev=True, has_next=has_more)
+    await callback.message.edit_text(format_users_page(users), reply_markup=keyboard)
 
 
 @router.message(Command("stats"))
@@ -69,11 +131,10 @@ async def detailed_stats(message: Message):
         await message.answer("У вас нет доступа к админ-панели.")
         return
     
-    stats = await get_funnel_stats()
-    users = await get_all_users()
-    
-    total_users = len(users)
-    discount_claimed = sum(1 for u in users if u.get('discount_claimed'))
+    total_users = await count_users()
+    discount_claimed = await count_discount_claimed()
+    conversion = await get_funnel_conversion()
+    signups = await get_signups_by_day(7)
     
     text = f"""📊 Детальная статистика
 
@@ -84,10 +145,21 @@ async def detailed_stats(message: Message):
 📋 Шаги воронки:
 """
     
-    for step, count in sorted(stats.items()):
-        percentage = round(count / total_users * 100, 2) if total_users > 0 else 0
+    for step, count, percentage in conversion:
         text += f"  • {step}: {count} ({percentage}%)\n"
     
+    if signups:
+        text += "\n🗓 Новые пользователи за 7 дней:\n"
+        for day, count in signups:
+            text += f"  • {day}: {count}\n"
+    
+    if RATE_LIMIT_ENABLED:
+        send_stats = rate_limiter.stats
+        text += (
+            f"\n📤 Очередь отправки: сейчас {send_stats['waiting']}, максимум {send_stats['max_waiting']}, "
+            f"задержано {send_stats['delayed']}, повторов {send_stats['retries']}, ошибок {send_stats['failed']}\n"
+        )
+    
     await message.answer(text)
 
 
@@ -129,3 +201,55 @@ Instagram: {user_data.get('instagram_nick', 'Не указано')}
     
     await message.answer(text)
 
+
+
+@router.message(Command("export"))
+async def export_data(message: Message):
+    """Выгрузка таблицы в сжатый CSV/JSONL файл"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("У вас нет доступа к админ-панели.")
+        return
+    
+    usage = (
+        "Использование: /export <users|answers|funnel> [csv|jsonl] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]\n"
+        "Например: /export answers jsonl 2025-01-01 2025-01-31 или /export users с 2025-01-01"
+    )
+    args = message.text.split()[1:]
+    if not args or args[0] not in EXPORT_TABLES:
+        await message.answer(usage)
+        return
+    
+    name = args.pop(0)
+    fmt = "csv"
+    if args and args[0] in EXPORT_FORMATS:
+        fmt = args.pop(0)
+    
+    # Даты пишутся после «с»/«по» или просто подряд: первая — начало, вторая — конец
+    dates = {"с": None, "по": None}
+    try:
+        while args:
+            value = args.pop(0)
+            key = value.lower()
+            if key in dates:
+                if not args:
+                    raise ValueError(f"После «{value}» нужна дата")
+                value = args.pop(0)
+            else:
+                key = next((key for key, parsed in dates.items() if parsed is None), None)
+                if key is None:
+                    raise ValueError(f"Лишний аргумент: {value}")
+            dates[key] = parse_date(value)
+    except ValueError as e:
+        await message.answer(f"{e}\n\n{usage}")
+        return
+    date_from, date_to = dates["с"], dates["по"]
+    
+    await message.answer("⏳ Готовлю выгрузку...")
+    path, total = await export_table(name, fmt=fmt, date_from=date_from, date_to=date_to)
+    try:
+        await message.answer_document(FSInputFile(path), caption=f"📦 {name}: {total} строк")
+    finally:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"Ошибка при удалении файла выгрузки {path}: {e}")
@@ -1,20 +1,59 @@
-import os
 import logging
+from functools import partial
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, InputMediaPhoto
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 from database import save_user_data, save_answer, log_funnel_step
 from states import GameStates
-from cards import get_card_path, get_all_cards, get_gift_card_path, get_all_gift_cards
+from cards import get_card_path, get_gift_card_path, gift_catalog, resolve_deck
+from media_cache import file_id_cache
+from cleanup import delete_messages_later
+from pagination import page_coalescer
+from keyboards import card_keyboard, gift_card_keyboard
+from scheduler import scheduler
+from config import REMINDER_CARD_DESCRIPTION_DELAY, REMINDER_DISCOUNT_DELAY
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+# Кнопки перелистывания: повторные нажатия не отбрасываются, а объединяются (см. pagination.py)
+PAGINATION_CALLBACK_PREFIXES = (
+    "card_prev_", "card_next_",
+    "gift_gift_card_1_prev_", "gift_gift_card_1_next_",
+    "gift_gift_card_2_prev_", "gift_gift_card_2_next_",
+)
+
+
+def get_cards_list(data: dict) -> tuple:
+    """Колода карт пользователя по ссылке из данных FSM"""
+    return resolve_deck(data.get("deck"))
+
+
+def get_gift_cards_list(data: dict) -> tuple:
+    """Карты подарков, доступные пользователю (колода без уже выбранных карт)"""
+    return resolve_deck(data.get("gift_deck"), tuple(data.get("gift_excluded", ())))
+
+
+def page_key(callback: CallbackQuery) -> tuple:
+    """Ключ перелистываемого сообщения"""
+    return callback.message.chat.id, callback.message.message_id
+
+
+def current_page(callback: CallbackQuery) -> int:
+    """Номер карты, от которой считать перелистывание.
+
+    Пока предыдущие нажатия не отрисованы, на кнопке остается старый номер,
+    поэтому отсчет ведется от последней запрошенной карты.
+    """
+    target = page_coalescer.target(page_key(callback))
+    return target if target is not None else int(callback.data.split("_")[-1])
+
 
 async def show_card_with_pagination(message: Message, state: FSMContext, card_index: int):
     """Показать карту с кнопками пагинации"""
     data = await state.get_data()
-    cards_list = data.get("cards_list", [])
+    cards_list = get_cards_list(data)
     
     if not cards_list or card_index < 0 or card_index >= len(cards_list):
         return
@@ -22,42 +61,24 @@ async def show_card_with_pagination(message: Message, state: FSMContext, card_in
     card_filename = cards_list[card_index]
     card_path = get_card_path(card_filename)
     
-    if not card_path or not os.path.exists(card_path):
+    if not card_path:
         return
     
-    photo = FSInputFile(card_path)
-    
-    # Создаем кнопки навигации
-    keyboard_buttons = []
+    # Повторно отправляем уже загруженную картинку по file_id
+    photo = file_id_cache.input_file(card_path)
     
-    # Кнопки навигации с номером карты в центре
-    nav_buttons = []
-    if len(cards_list) > 1:
-        if card_index > 0:
-            nav_buttons.append(InlineKeyboardButton(text="◀️ Предыдущая", callback_data=f"card_prev_{card_index}"))
-        
-        # Номер карты в центре (неактивная кнопка)
-        nav_buttons.append(InlineKeyboardButton(text=f"{card_index + 1}/{len(cards_list)}", callback_data="card_number"))
-        
-        if card_index < len(cards_list) - 1:
-            nav_buttons.append(InlineKeyboardButton(text="Следующая ▶️", callback_data=f"card_next_{card_index}"))
-        
-        if nav_buttons:
-            keyboard_buttons.append(nav_buttons)
-    
-    # Кнопка выбора карты
-    keyboard_buttons.append([InlineKeyboardButton(text="Выбрать эту карту", callback_data=f"card_select_{card_index}")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    # Готовая клавиатура навигации из кэша
+    keyboard = card_keyboard(card_index, len(cards_list))
     
     # Отправляем или обновляем сообщение (без caption)
     if message.photo:
         # Обновляем существующее сообщение
         media = InputMediaPhoto(media=photo)
-        await message.edit_media(media=media, reply_markup=keyboard)
+        sent_message = await message.edit_media(media=media, reply_markup=keyboard)
     else:
         # Отправляем новое сообщение
-        await message.answer_photo(photo, reply_markup=keyboard)
+        sent_message = await message.answer_photo(photo, reply_markup=keyboard)
+    await file_id_cache.remember(card_path, sent_message)
 
 
 # Обработчики навигации по картам
@@ -65,10 +86,10 @@ async def show_card_with_pagination(message: Message, state: FSMContext, card_in
 async def card_previous(callback: CallbackQuery, state: FSMContext):
     """Переход к предыдущей карте"""
     await callback.answer()
-    card_index = int(callback.data.split("_")[-1])
+    card_index = current_page(callback)
     new_index = max(0, card_index - 1)
     await state.update_data(current_card_index=new_index)
-    await show_card_with_pagination(callback.message, state, new_index)
+    page_coalescer.request(page_key(callback), new_index, partial(show_card_with_pagination, callback.message, state))
 
 
 @router.callback_query(F.data.startswith("card_next_"))
@@ -76,11 +97,11 @@ async def card_next(callback: CallbackQuery, state: FSMContext):
     """Переход к следующей карте"""
     await callback.answer()
     data = await state.get_data()
-    cards_list = data.get("cards_list", [])
-    card_index = int(callback.data.split("_")[-1])
+    cards_list = get_cards_list(data)
+    card_index = current_page(callback)
     new_index = min(len(cards_list) - 1, card_index + 1)
     await state.update_data(current_card_index=new_index)
-    await show_card_with_pagination(callback.message, state, new_index)
+    page_coalescer.request(page_key(callback), new_index, partial(show_card_with_pagination, callback.message, state))
 
 
 @router.callback_query(F.data == "card_number")
@@ -96,7 +117,7 @@ async def card_select(callback: CallbackQuery, state: FSMContext):
     
     card_index = int(callback.data.split("_")[-1])
     data = await state.get_data()
-    cards_list = data.get("cards_list", [])
+    cards_list = get_cards_list(data)
     
     if 0 <= card_index < len(cards_list):
         selected_card = cards_list[card_index]
@@ -107,11 +128,27 @@ async def card_select(callback: CallbackQuery, state: FSMContext):
         text = "👁️ Напиши, что ты видишь на этой карте. Просто опиши изображение."
         await callback.message.answer(text)
         await state.set_state(GameStates.waiting_for_card_description)
+        if REMINDER_CARD_DESCRIPTION_DELAY:
+            scheduler.schedule("card_description_reminder", callback.from_user.id, REMINDER_CARD_DESCRIPTION_DELAY,
+                               {"chat_id": callback.message.chat.id})
+
+
+@scheduler.job("card_description_reminder")
+async def card_description_reminder(bot, storage, user_id: int, payload: dict):
+    """Напоминание, если пользователь так и не описал выбранную карту"""
+    chat_id = payload["chat_id"]
+    key = StorageKey(bot_id=bot.id, chat_id=chat_id, user_id=user_id)
+    if await storage.get_state(key) != GameStates.waiting_for_card_description.state:
+        return
+    
+    text = "👁️ Твоя карта ждёт тебя! Напиши, что ты видишь на ней — просто опиши изображение."
+    await bot.send_message(chat_id, text)
 
 
 @router.message(GameStates.waiting_for_card_description)
 async def process_card_description(message: Message, state: FSMContext):
     """Обработка описания карты"""
+    scheduler.cancel((message.from_user.id, "card_description_reminder"))
     description = message.text.strip()
     await save_answer(message.from_user.id, 1, description)
     await log_funnel_step(message.from_user.id, "card_description")
@@ -217,15 +254,16 @@ async def start_gift_selection(callback: CallbackQuery, state: FSMContext):
     except:
         gift_start_text_message_id = None
     
-    # Получаем все карты подарков из папки gift_images
-    all_cards = get_all_gift_cards()
-    if not all_cards:
+    # Текущая колода карт подарков из каталога gift_images
+    gift_deck = gift_catalog.deck_id
+    if not resolve_deck(gift_deck):
         await callback.message.answer("❌ Карты подарков не найдены!")
         return
     
-    # Сохраняем список карт и начинаем с первой карты
+    # Сохраняем ссылку на колоду (не сам список) и начинаем с первой карты
     await state.update_data(
-        gift_cards_list=all_cards,
+        gift_deck=gift_deck,
+        gift_excluded=[],
         current_gift_card_index=0,
         gift_type="gift_card_1",
         gift_card_1_selected=False,
@@ -245,7 +283,7 @@ async def start_gift_selection(callback: CallbackQuery, state: FSMContext):
 async def show_gift_card_with_pagination(message: Message, state: FSMContext, card_index: int, gift_type: str):
     """Показать карту подарка с кнопками пагинации"""
     data = await state.get_data()
-    cards_list = data.get("gift_cards_list", [])
+    cards_list = get_gift_cards_list(data)
     
     if not cards_list or card_index < 0 or card_index >= len(cards_list):
         return None
@@ -253,43 +291,26 @@ async def show_gift_card_with_pagination(message: Message, state: FSMContext, ca
     card_filename = cards_list[card_index]
     card_path = get_gift_card_path(card_filename)
     
-    if not card_path or not os.path.exists(card_path):
+    if not card_path:
         return None
     
-    photo = FSInputFile(card_path)
-    
-    # Создаем кнопки навигации
-    keyboard_buttons = []
-    
-    # Кнопки навигации с номером карты в центре
-    nav_buttons = []
-    if len(cards_list) > 1:
-        if card_index > 0:
-            nav_buttons.append(InlineKeyboardButton(text="◀️ Предыдущая", callback_data=f"gift_{gift_type}_prev_{card_index}"))
-        
-        # Номер карты в центре (неактивная кнопка)
-        nav_buttons.append(InlineKeyboardButton(text=f"{card_index + 1}/{len(cards_list)}", callback_data=f"gift_{gift_type}_number"))
-        
-        if card_index < len(cards_list) - 1:
-            nav_buttons.append(InlineKeyboardButton(text="Следующая ▶️", callback_data=f"gift_{gift_type}_next_{card_index}"))
-        
-        if nav_buttons:
-            keyboard_buttons.append(nav_buttons)
+    # Повторно отправляем уже загруженную картинку по file_id
+    photo = file_id_cache.input_file(card_path)
     
-    # Кнопка выбора карты
-    keyboard_buttons.append([InlineKeyboardButton(text="Выбрать эту карту", callback_data=f"gift_{gift_type}_select_{card_index}")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    # Готовая клавиатура навигации из кэша
+    keyboard = gift_card_keyboard(gift_type, card_index, len(cards_list))
     
     # Отправляем или обновляем сообщение (без caption)
     if message.photo:
         # Обновляем существующее сообщение
         media = InputMediaPhoto(media=photo)
-        await message.edit_media(media=media, reply_markup=keyboard)
+        edited_message = await message.edit_media(media=media, reply_markup=keyboard)
+        await file_id_cache.remember(card_path, edited_message)
         return message
     else:
         # Отправляем новое сообщение
         sent_message = await message.answer_photo(photo, reply_markup=keyboard)
+        await file_id_cache.remember(card_path, sent_message)
         return sent_message
 
 
@@ -298,10 +319,13 @@ async def show_gift_card_with_pagination(message: Message, state: FSMContext, ca
 async def gift_card_1_previous(callback: CallbackQuery, state: FSMContext):
     """Переход к предыдущей карте подарка 1"""
     await callback.answer()
-    card_index = int(callback.data.split("_")[-1])
+    card_index = current_page(callback)
     new_index = max(0, card_index - 1)
     await state.update_data(current_gift_card_index=new_index)
-    await show_gift_card_with_pagination(callback.message, state, new_index, "gift_card_1")
+    page_coalescer.request(
+        page_key(callback), new_index,
+        partial(show_gift_card_with_pagination, callback.message, state, gift_type="gift_card_1")
+    )
 
 
 @router.callback_query(F.data.startswith("gift_gift_card_1_next_"))
@@ -309,11 +333,14 @@ async def gift_card_1_next(callback: CallbackQuery, state: FSMContext):
     """Переход к следующей карте подарка 1"""
     await callback.answer()
     data = await state.get_data()
-    cards_list = data.get("gift_cards_list", [])
-    card_index = int(callback.data.split("_")[-1])
+    cards_list = get_gift_cards_list(data)
+    card_index = current_page(callback)
     new_index = min(len(cards_list) - 1, card_index + 1)
     await state.update_data(current_gift_card_index=new_index)
-    await show_gift_card_with_pagination(callback.message, state, new_index, "gift_card_1")
+    page_coalescer.request(
+        page_key(callback), new_index,
+        partial(show_gift_card_with_pagination, callback.message, state, gift_type="gift_card_1")
+    )
 
 
 @router.callback_query(F.data == "gift_gift_card_1_number")
@@ -330,7 +357,7 @@ async def gift_card_1_select(callback: CallbackQuery, state: FSMContext):
     try:
         card_index = int(callback.data.split("_")[-1])
         data = await state.get_data()
-        cards_list = data.get("gift_cards_list", [])
+        cards_list = get_gift_cards_list(data)
         
         if 0 <= card_index < len(cards_list):
             selected_card = cards_list[card_index]
@@ -344,34 +371,29 @@ async def gift_card_1_select(callback: CallbackQuery, state: FSMContext):
                 gift_card_1_msg_id = callback.message.message_id
                 await state.update_data(gift_card_1_message_id=gift_card_1_msg_id)
             
-            # Удаляем сообщение "🎁 Выбери первую карту подарка:"
-            gift_start_text_msg_id = data.get("gift_start_text_message_id")
-            if gift_start_text_msg_id:
-                try:
-                    await callback.bot.delete_message(chat_id=callback.message.chat.id, message_id=gift_start_text_msg_id)
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении сообщения о выборе первой карты: {e}")
-            
-            # Удаляем сообщение с картинкой первой карты
-            try:
-                await callback.bot.delete_message(chat_id=callback.message.chat.id, message_id=gift_card_1_msg_id)
-            except Exception as e:
-                logger.error(f"Ошибка при удалении сообщения с первой картой подарка: {e}")
+            # Удаляем в фоне сообщение "🎁 Выбери первую карту подарка:" и картинку первой карты
+            delete_messages_later(
+                callback.bot,
+                callback.message.chat.id,
+                [data.get("gift_start_text_message_id"), gift_card_1_msg_id]
+            )
             
             # Автоматически переходим к выбору второго подарка
-            all_cards = data.get("gift_cards_list", [])
+            gift_deck = data.get("gift_deck")
+            all_cards = resolve_deck(gift_deck)
             
             if all_cards:
-                # Создаем новый список карт без первой выбранной карты
-                remaining_cards = [card for card in all_cards if card != selected_card]
+                # Исключаем первую выбранную карту по ее индексу в колоде
+                gift_excluded = sorted(set(data.get("gift_excluded", [])) | {all_cards.index(selected_card)})
+                remaining_cards = resolve_deck(gift_deck, tuple(gift_excluded))
                 
                 if not remaining_cards:
                     await callback.message.answer("❌ Больше нет доступных карт для выбора!")
                     return
                 
-                # Сохраняем обновленный список карт для второго выбора
+                # Сохраняем исключенные индексы для второго выбора
                 await state.update_data(
-                    gift_cards_list=remaining_cards,
+                    gift_excluded=gift_excluded,
                     current_gift_card_index=0,
                     gift_type="gift_card_2",
                     selected_gift_card_1=selected_card
@@ -383,31 +405,20 @@ async def gift_card_1_select(callback: CallbackQuery, state: FSMContext):
                 
                 # Отправляем первую карту для второго подарка (из оставшихся карт)
                 # Используем bot напрямую, так как callback.message уже удалено
-                from aiogram.types import FSInputFile
-                from cards import get_gift_card_path
-                import os
-                
                 first_remaining_card = remaining_cards[0]
                 card_path = get_gift_card_path(first_remaining_card)
-                if card_path and os.path.exists(card_path):
-                    photo = FSInputFile(card_path)
-                    
-                    # Создаем кнопки навигации
-                    keyboard_buttons = []
-                    nav_buttons = []
-                    if len(remaining_cards) > 1:
-                        nav_buttons.append(InlineKeyboardButton(text=f"1/{len(remaining_cards)}", callback_data="gift_gift_card_2_number"))
-                        nav_buttons.append(InlineKeyboardButton(text="Следующая ▶️", callback_data=f"gift_gift_card_2_next_0"))
-                        keyboard_buttons.append(nav_buttons)
+                if card_path:
+                    photo = file_id_cache.input_file(card_path)
                     
-                    keyboard_buttons.append([InlineKeyboardButton(text="Выбрать эту карту", callback_data=f"gift_gift_card_2_select_0")])
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+                    # Готовая клавиатура навигации из кэша
+                    keyboard = gift_card_keyboard("gift_card_2", 0, len(remaining_cards))
                     
                     gift_message = await callback.bot.send_photo(
                         chat_id=callback.message.chat.id,
                         photo=photo,
                         reply_markup=keyboard
                     )
+                    await file_id_cache.remember(card_path, gift_message)
                     await state.update_data(gift_card_2_message_id=gift_message.message_id)
                 
                 await state.set_state(GameStates.waiting_for_gift_card_2)
@@ -426,10 +437,13 @@ async def gift_card_1_selected_click(callback: CallbackQuery):
 async def gift_card_2_previous(callback: CallbackQuery, state: FSMContext):
     """Переход к предыдущей карте подарка 2"""
     await callback.answer()
-    card_index = int(callback.data.split("_")[-1])
+    card_index = current_page(callback)
     new_index = max(0, card_index - 1)
     await state.update_data(current_gift_card_index=new_index)
-    await show_gift_card_with_pagination(callback.message, state, new_index, "gift_card_2")
+    page_coalescer.request(
+        page_key(callback), new_index,
+        partial(show_gift_card_with_pagination, callback.message, state, gift_type="gift_card_2")
+    )
 
 
 @router.callback_query(F.data.startswith("gift_gift_card_2_next_"))
@@ -437,11 +451,14 @@ async def gift_card_2_next(callback: CallbackQuery, state: FSMContext):
     """Переход к следующей карте подарка 2"""
     await callback.answer()
     data = await state.get_data()
-    cards_list = data.get("gift_cards_list", [])
-    card_index = int(callback.data.split("_")[-1])
+    cards_list = get_gift_cards_list(data)
+    card_index = current_page(callback)
     new_index = min(len(cards_list) - 1, card_index + 1)
     await state.update_data(current_gift_card_index=new_index)
-    await show_gift_card_with_pagination(callback.message, state, new_index, "gift_card_2")
+    page_coalescer.request(
+        page_key(callback), new_index,
+        partial(show_gift_card_with_pagination, callback.message, state, gift_type="gift_card_2")
+    )
 
 
 @router.callback_query(F.data == "gift_gift_card_2_number")
@@ -458,7 +475,7 @@ async def gift_card_2_select(callback: CallbackQuery, state: FSMContext):
     try:
         card_index = int(callback.data.split("_")[-1])
         data = await state.get_data()
-        cards_list = data.get("gift_cards_list", [])
+        cards_list = get_gift_cards_list(data)
         
         if 0 <= card_index < len(cards_list):
             selected_card = cards_list[card_index]
@@ -466,19 +483,7 @@ async def gift_card_2_select(callback: CallbackQuery, state: FSMContext):
             await log_funnel_step(callback.from_user.id, "gift_card_2")
             
             # Меняем кнопку на "выбран" в том же сообщении (быстро, без edit_media)
-            keyboard_buttons = []
-            nav_buttons = []
-            if len(cards_list) > 1:
-                if card_index > 0:
-                    nav_buttons.append(InlineKeyboardButton(text="◀️ Предыдущая", callback_data=f"gift_gift_card_2_prev_{card_index}"))
-                nav_buttons.append(InlineKeyboardButton(text=f"{card_index + 1}/{len(cards_list)}", callback_data="gift_gift_card_2_number"))
-                if card_index < len(cards_list) - 1:
-                    nav_buttons.append(InlineKeyboardButton(text="Следующая ▶️", callback_data=f"gift_gift_card_2_next_{card_index}"))
-                if nav_buttons:
-                    keyboard_buttons.append(nav_buttons)
-            
-            keyboard_buttons.append([InlineKeyboardButton(text="✅ Выбрано", callback_data="gift_card_2_selected")])
-            keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+            keyboard = gift_card_keyboard("gift_card_2", card_index, len(cards_list), selected=True)
             
             # Быстро обновляем только кнопки, без изменения медиа
             await callback.message.edit_reply_markup(reply_markup=keyboard)
@@ -486,21 +491,13 @@ async def gift_card_2_select(callback: CallbackQuery, state: FSMContext):
             # Помечаем второй подарок как выбранный
             await state.update_data(gift_card_2_selected=True, selected_gift_card_2=selected_card)
             
-            # Удаляем сообщения с картинками подарков и текстовые сообщения
+            # Удаляем в фоне сообщения с картинками подарков и текстовые сообщения
             data = await state.get_data()
-            gift_card_1_msg_id = data.get("gift_card_1_message_id")
-            gift_card_2_msg_id = data.get("gift_card_2_message_id")
-            gift_card_2_text_msg_id = data.get("gift_card_2_text_message_id")
-            
-            try:
-                if gift_card_1_msg_id:
-                    await callback.bot.delete_message(chat_id=callback.message.chat.id, message_id=gift_card_1_msg_id)
-                if gift_card_2_msg_id:
-                    await callback.bot.delete_message(chat_id=callback.message.chat.id, message_id=gift_card_2_msg_id)
-                if gift_card_2_text_msg_id:
-                    await callback.bot.delete_message(chat_id=callback.message.chat.id, message_id=gift_card_2_text_msg_id)
-            except Exception as e:
-                logger.error(f"Ошибка при удалении сообщений с подарками: {e}")
+            delete_messages_later(callback.bot, callback.message.chat.id, [
+                data.get("gift_card_1_message_id"),
+                data.get("gift_card_2_message_id"),
+                data.get("gift_card_2_text_message_id"),
+            ])
             
             # Теперь отправляем финальный текст
             text = """✨ В 60% случаев подарки, которые выпадают в игре, проявляются и в реальной жизни.
@@ -528,6 +525,9 @@ async def gift_card_2_select(callback: CallbackQuery, state: FSMContext):
             ])
             
             await callback.message.answer(discount_text, reply_markup=keyboard2)
+            if REMINDER_DISCOUNT_DELAY:
+                scheduler.schedule("discount_reminder", callback.from_user.id, REMINDER_DISCOUNT_DELAY,
+                                   {"chat_id": callback.message.chat.id})
     except (ValueError, IndexError) as e:
         logger.error(f"Ошибка при выборе второго подарка: {e}")
 
@@ -1,14 +1,17 @@
-import asyncio
 import logging
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from database import save_user_data, log_funnel_step
 from states import GameStates
+from scheduler import scheduler
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+# Длительность анимации кубика в Telegram, секунд
+DICE_ANIMATION_DELAY = 4
+
 
 @router.callback_query(F.data == "roll_dice")
 async def roll_dice(callback: CallbackQuery, state: FSMContext):
@@ -22,16 +25,21 @@ async def roll_dice(callback: CallbackQuery, state: FSMContext):
     logger.info(f"Кубик отправлен, message_id={dice_message.message_id}, chat_id={dice_message.chat.id}, value={dice_value}")
     logger.info(f"Результат кубика: {dice_value}, ждем завершения анимации...")
     
-    # Ждем завершения анимации (около 4 секунд)
-    await asyncio.sleep(4)
-    logger.info(f"Анимация завершена, обрабатываем результат: {dice_value}")
-    
-    # Обрабатываем результат
-    await handle_dice_result(callback.message, state, dice_value)
+    # Результат обрабатываем после анимации, не занимая обработчик на время ожидания.
+    # Повторный бросок до окончания анимации заменяет предыдущий
+    scheduler.call_later(
+        (callback.from_user.id, "dice"),
+        DICE_ANIMATION_DELAY,
+        handle_dice_result,
+        callback.message,
+        state,
+        dice_value
+    )
 
 
 async def handle_dice_result(message: Message, state: FSMContext, dice_value: int):
     """Обработка результата броска кубика"""
+    logger.info(f"Анимация завершена, обрабатываем результат: {dice_value}")
     await save_user_data(message.from_user.id, dice_result=dice_value)
     await log_funnel_step(message.from_user.id, f"dice_rolled_{dice_value}")
     
@@ -49,15 +57,16 @@ async def handle_dice_result(message: Message, state: FSMContext, dice_value: in
         
         # Сразу отправляем выбор карты
         from handlers.cards import show_card_with_pagination
-        from cards import get_all_cards
+        from cards import card_catalog, resolve_deck
         
-        all_cards = get_all_cards()
-        if not all_cards:
+        deck = card_catalog.deck_id
+        if not resolve_deck(deck):
             await message.answer("❌ Карты не найдены!")
             return
         
+        # В FSM храним только ссылку на общую колоду
         await state.update_data(
-            cards_list=all_cards,
+            deck=deck,
             current_card_index=0
         )
         
@@ -146,20 +155,21 @@ async def continue_anyway(callback: CallbackQuery, state: FSMContext):
     
     # Затем отправляем карты
     from handlers.cards import show_card_with_pagination
-    from cards import get_all_cards
+    from cards import card_catalog, resolve_deck
     
     logger.info("Получаем список карт...")
-    all_cards = get_all_cards()
-    logger.info(f"Найдено карт: {len(all_cards) if all_cards else 0}")
+    deck = card_catalog.deck_id
+    all_cards = resolve_deck(deck)
+    logger.info(f"Найдено карт: {len(all_cards)}")
     
     if not all_cards:
         logger.warning("Карты не найдены!")
         await callback.message.answer("❌ Карты не найдены!")
         return
     
-    # Сохраняем список карт и начинаем с первой (индекс 0)
+    # Сохраняем ссылку на колоду и начинаем с первой карты (индекс 0)
     await state.update_data(
-        cards_list=all_cards,
+        deck=deck,
         current_card_index=0
     )
     
@@ -172,24 +182,19 @@ async def continue_anyway(callback: CallbackQuery, state: FSMContext):
     except Exception as e:
         logger.error(f"Ошибка при отправке карты: {e}")
         # Если не получилось, отправляем напрямую
-        from aiogram.types import FSInputFile
         from cards import get_card_path
-        import os
+        from media_cache import file_id_cache
         
         first_card = all_cards[0]
         card_path = get_card_path(first_card)
-        if card_path and os.path.exists(card_path):
-            photo = FSInputFile(card_path)
-            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+        if card_path:
+            photo = file_id_cache.input_file(card_path)
+            from keyboards import card_keyboard
             
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Предыдущая", callback_data="card_prev_0")],
-                [InlineKeyboardButton(text="1/3", callback_data="card_number")],
-                [InlineKeyboardButton(text="Следующая ▶️", callback_data="card_next_0")],
-                [InlineKeyboardButton(text="Выбрать эту карту", callback_data="card_select_0")]
-            ])
+            keyboard = card_keyboard(0, len(all_cards))
             
-            await callback.message.answer_photo(photo, reply_markup=keyboard)
+            sent_message = await callback.message.answer_photo(photo, reply_markup=keyboard)
+            await file_id_cache.remember(card_path, sent_message)
             logger.info("Карта отправлена напрямую")
     
     await state.set_state(GameStates.waiting_for_card_selection)
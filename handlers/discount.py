@@ -1,17 +1,33 @@
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
-from database import save_user_data, log_funnel_step
+from database import save_user_data, get_user_data, log_funnel_step
 from states import GameStates
+from scheduler import scheduler
 from config import INSTAGRAM_ACCOUNT
 
 router = Router()
 
 
+@scheduler.job("discount_reminder")
+async def discount_reminder(bot, storage, user_id: int, payload: dict):
+    """Напоминание о скидке, если пользователь ее еще не забрал"""
+    user = await get_user_data(user_id)
+    if user and user.get("discount_claimed"):
+        return
+    
+    text = "⏳ Напоминаем: скидка 15% на большую трансформационную игру всё ещё ждёт тебя ✨"
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💰 Хочу скидку 15%", callback_data="want_discount")]
+    ])
+    await bot.send_message(payload["chat_id"], text, reply_markup=keyboard)
+
+
 @router.callback_query(F.data == "want_discount")
 async def want_discount(callback: CallbackQuery, state: FSMContext):
     """Обработка запроса скидки"""
     await callback.answer()
+    scheduler.cancel((callback.from_user.id, "discount_reminder"))
     await log_funnel_step(callback.from_user.id, "discount_requested")
     
     text = "📱 Напиши свой ник в Instagram, чтобы мы могли проверить твою отметку:"
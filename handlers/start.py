@@ -3,6 +3,7 @@ from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from database import log_funnel_step
 from states import GameStates
+from scheduler import scheduler
 
 router = Router()
 
@@ -10,6 +11,8 @@ router = Router()
 @router.message(F.text == "/start")
 async def cmd_start(message: Message, state: FSMContext):
     """Обработчик команды /start"""
+    # Игра начинается заново: отложенные действия прошлой игры больше не нужны
+    scheduler.cancel_user(message.from_user.id)
     await state.clear()
     
     welcome_text = """✨ Добро пожаловать в мини-игру "Ты и Вселенная".
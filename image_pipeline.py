@@ -0,0 +1,87 @@
+import os
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from config import IMAGE_CACHE_DIR, IMAGE_MAX_SIDE, IMAGE_QUALITY, IMAGE_WORKERS
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении алгоритма обработки, чтобы старые копии не использовались
+PIPELINE_VERSION = 1
+
+
+def optimize_image(path: str, cache_dir: str, max_side: int, quality: int) -> str:
+    """Создание оптимизированной копии картинки (выполняется в отдельном процессе).
+
+    Имя копии — хэш содержимого исходника и настроек обработки, поэтому готовая копия
+    переиспользуется между запусками, а измененный файл получает новую копию.
+    Копия — прогрессивный JPEG без метаданных, большая сторона не больше max_side.
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(f"{PIPELINE_VERSION}:{max_side}:{quality}:".encode() + content).hexdigest()
+    variant_path = os.path.join(cache_dir, f"{digest}.jpg")
+    if os.path.exists(variant_path):
+        return variant_path
+    
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            # У JPEG нет прозрачности: кладем картинку на белый фон
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        
+        # Пишем во временный файл и переименовываем, чтобы не оставить недописанную копию
+        tmp_path = f"{variant_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, "JPEG", quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, variant_path)
+    return variant_path
+
+
+async def optimize_catalogs(catalogs, cache_dir: str = IMAGE_CACHE_DIR, max_side: int = IMAGE_MAX_SIDE,
+                            quality: int = IMAGE_QUALITY, workers: int = IMAGE_WORKERS):
+    """Подготовка оптимизированных копий для карт каталогов, у которых их еще нет"""
+    if Image is None:
+        logger.warning("Pillow не установлен, карты отправляются без оптимизации")
+        return 0
+    
+    pending = [(catalog, entry) for catalog in catalogs for entry in catalog.entries() if entry.variant_path is None]
+    if not pending:
+        return 0
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    # spawn: к этому моменту в процессе уже работают потоки aiosqlite, а fork многопоточного
+    # процесса небезопасен (дочерний процесс может унаследовать занятые блокировки)
+    executor = ProcessPoolExecutor(max_workers=workers or None, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = [
+            loop.run_in_executor(executor, optimize_image, entry.path, cache_dir, max_side, quality)
+            for _, entry in pending
+        ]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+    finally:
+        # Все задачи уже завершены; без ожидания процессов, чтобы не блокировать цикл событий
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    done = 0
+    for (catalog, entry), result in zip(pending, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при оптимизации {entry.path}: {result}")
+            continue
+        if catalog.set_variant(entry, result):
+            done += 1
+    logger.info(f"Оптимизировано картинок: {done} из {len(pending)}")
+    return done
@@ -0,0 +1,48 @@
+from functools import lru_cache
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+# Сколько разных клавиатур пагинации держать в памяти
+KEYBOARD_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def pagination_keyboard(prefix: str, index: int, total: int, selected_callback: str = None) -> InlineKeyboardMarkup:
+    """Клавиатура листания колоды: ◀️ номер ▶️ и кнопка выбора.
+
+    Зависит только от аргументов, поэтому один объект отдается всем пользователям;
+    его нельзя изменять после создания. Если передан selected_callback, вместо кнопки
+    выбора показывается «✅ Выбрано» с этим callback_data.
+    """
+    keyboard_buttons = []
+    
+    # Кнопки навигации с номером карты в центре
+    if total > 1:
+        nav_buttons = []
+        if index > 0:
+            nav_buttons.append(InlineKeyboardButton(text="◀️ Предыдущая", callback_data=f"{prefix}_prev_{index}"))
+        
+        # Номер карты в центре (неактивная кнопка)
+        nav_buttons.append(InlineKeyboardButton(text=f"{index + 1}/{total}", callback_data=f"{prefix}_number"))
+        
+        if index < total - 1:
+            nav_buttons.append(InlineKeyboardButton(text="Следующая ▶️", callback_data=f"{prefix}_next_{index}"))
+        
+        keyboard_buttons.append(nav_buttons)
+    
+    # Кнопка выбора карты
+    if selected_callback:
+        keyboard_buttons.append([InlineKeyboardButton(text="✅ Выбрано", callback_data=selected_callback)])
+    else:
+        keyboard_buttons.append([InlineKeyboardButton(text="Выбрать эту карту", callback_data=f"{prefix}_select_{index}")])
+    
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+
+def card_keyboard(index: int, total: int) -> InlineKeyboardMarkup:
+    """Клавиатура листания основной колоды"""
+    return pagination_keyboard("card", index, total)
+
+
+def gift_card_keyboard(gift_type: str, index: int, total: int, selected: bool = False) -> InlineKeyboardMarkup:
+    """Клавиатура листания карт подарка gift_type (gift_card_1 или gift_card_2)"""
+    return pagination_keyboard(f"gift_{gift_type}", index, total, f"{gift_type}_selected" if selected else None)
@@ -1,10 +1,12 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN
-from database import init_db
-from handlers import start, name, request, dice, cards, discount, admin
+from config import BOT_MODE, WORKERS
+from database import init_db, init_pool, close_pool
+from media_cache import file_id_cache
+from scheduler import scheduler
+from cleanup import wait_pending as wait_pending_cleanup
+from webhook import run_webhook
+from app import create_bot, create_dispatcher, prepare_catalogs, warm_up_catalogs, start_metrics, run_until_terminated
 
 # Настройка логирования
 logging.basicConfig(
@@ -16,27 +18,52 @@ logger = logging.getLogger(__name__)
 
 async def main():
     """Главная функция запуска бота"""
-    # Инициализация базы данных
+    if WORKERS > 1:
+        # Несколько рабочих процессов с распределением обновлений по user_id
+        from supervisor import run_supervisor
+        await run_supervisor(WORKERS)
+        return
+    
+    # Инициализация пула соединений и базы данных
+    await init_pool()
     await init_db()
     logger.info("База данных инициализирована")
     
     # Создание бота и диспетчера
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
-    
-    # Регистрация роутеров
-    dp.include_router(start.router)
-    dp.include_router(name.router)
-    dp.include_router(request.router)
-    dp.include_router(dice.router)
-    dp.include_router(cards.router)
-    dp.include_router(discount.router)
-    dp.include_router(admin.router)
-    
-    logger.info("Бот запущен")
-    
-    # Запуск polling
-    await dp.start_polling(bot)
+    bot = create_bot()
+    dp = create_dispatcher()
+    
+    catalog_watcher = await prepare_catalogs()
+    
+    # file_id уже загруженных картинок, чтобы не отправлять файлы повторно
+    await file_id_cache.load(bot.id)
+    
+    # Предзагрузка всей колоды, чтобы даже первый пользователь получал карты по file_id
+    await warm_up_catalogs(bot)
+    
+    # Планировщик напоминаний: загружаем задачи, сохраненные до перезапуска
+    await scheduler.start(bot, dp.storage)
+    
+    # /metrics (если METRICS_ENABLED)
+    metrics_runner = await start_metrics(dp)
+    
+    logger.info(f"Бот запущен ({BOT_MODE})")
+    
+    try:
+        if BOT_MODE == "webhook":
+            # SIGTERM в polling обрабатывает сам aiogram, для webhook — run_until_terminated
+            await run_until_terminated(run_webhook(dp, bot))
+        else:
+            # Webhook и getUpdates не работают одновременно
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        catalog_watcher.cancel()
+        await scheduler.close()
+        await wait_pending_cleanup()
+        await close_pool()
 
 
 if __name__ == "__main__":
@@ -44,4 +71,3 @@ if __name__ == "__main__":
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен")
-
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import logging
+from config import EXPORT_DIR
+from database import init_db, init_pool, close_pool, rebuild_funnel_counters
+from export import EXPORT_TABLES, EXPORT_FORMATS, export_table, parse_date
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+async def backfill_counters(args):
+    """Пересчет счетчиков воронки по истории событий"""
+    total = await rebuild_funnel_counters()
+    logger.info(f"Счетчики воронки пересчитаны, учтено событий: {total}")
+
+
+async def export(args):
+    """Выгрузка таблицы в сжатый CSV или JSONL файл"""
+    path, total = await export_table(
+        args.table,
+        fmt=args.format,
+        date_from=args.date_from,
+        date_to=args.date_to,
+        directory=args.output_dir
+    )
+    logger.info(f"Выгружено строк: {total}, файл: {path}")
+
+
+COMMANDS = {
+    "backfill-counters": backfill_counters,
+    "export": export,
+}
+
+
+async def run(args):
+    """Запуск команды с открытым пулом соединений"""
+    await init_pool()
+    try:
+        await init_db()
+        await COMMANDS[args.command](args)
+    finally:
+        await close_pool()
+
+
+def main():
+    """Служебные команды бота"""
+    parser = argparse.ArgumentParser(description="Служебные команды бота")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill-counters", help="пересчитать счетчики воронки по таблице funnel_stats")
+    
+    export_parser = subparsers.add_parser("export", help="выгрузить таблицу в сжатый CSV или JSONL файл")
+    export_parser.add_argument("table", choices=list(EXPORT_TABLES))
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export_parser.add_argument("--from", dest="date_from", type=parse_date, help="начальная дата ГГГГ-ММ-ДД")
+    export_parser.add_argument("--to", dest="date_to", type=parse_date, help="конечная дата ГГГГ-ММ-ДД (включительно)")
+    export_parser.add_argument("--output-dir", default=EXPORT_DIR)
+    
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
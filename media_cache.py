@@ -0,0 +1,126 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from aiogram.types import FSInputFile, Message
+from cards import get_entry_by_path
+from database import get_pool, get_write_queue
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """Кэш file_id Telegram для локальных изображений.
+
+    После первой загрузки файла Telegram возвращает file_id, по которому то же изображение
+    можно отправлять повторно без загрузки. Запись привязана к (папка, имя файла) и действительна,
+    пока у файла не изменились время модификации и размер. file_id действуют только для
+    загрузившего их бота, поэтому кэш хранится отдельно для каждого bot_id.
+    """
+
+    def __init__(self):
+        self.bot_id = None
+        self._entries = {}
+
+    async def load(self, bot_id: int):
+        """Загрузка сохраненных file_id бота из базы данных"""
+        self.bot_id = bot_id
+        async with get_pool().reader() as db:
+            async with db.execute(
+                "SELECT directory, filename, mtime_ns, size, file_id FROM telegram_files WHERE bot_id = ?",
+                (bot_id,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        self._entries = {(directory, filename): (mtime_ns, size, file_id)
+                         for directory, filename, mtime_ns, size, file_id in rows}
+        logger.info(f"Загружено file_id из кэша: {len(self._entries)}")
+
+    @staticmethod
+    def _key(path: str):
+        directory, filename = os.path.split(os.path.normpath(path))
+        return directory, filename
+
+    @staticmethod
+    def _signature(path: str):
+        # Для карт берем данные из каталога, чтобы не обращаться к файловой системе
+        entry = get_entry_by_path(path)
+        if entry is not None:
+            return entry.mtime_ns, entry.size
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get_file_id(self, path: str):
+        """file_id для файла, если он уже загружался и с тех пор не менялся"""
+        entry = self._entries.get(self._key(path))
+        if entry is None:
+            return None
+        mtime_ns, size, file_id = entry
+        if (mtime_ns, size) != self._signature(path):
+            return None
+        return file_id
+
+    def input_file(self, path: str):
+        """Что передать в answer_photo/InputMediaPhoto: file_id из кэша или сам файл"""
+        return self.get_file_id(path) or FSInputFile(path)
+
+    async def remember(self, path: str, message):
+        """Сохранение file_id из ответа Telegram на отправку или редактирование фото"""
+        if self.bot_id is None or not isinstance(message, Message) or not message.photo:
+            return
+        key = self._key(path)
+        mtime_ns, size = self._signature(path)
+        entry = self._entries.get(key)
+        if entry is not None and entry[:2] == (mtime_ns, size):
+            # Для неизменившегося файла уже есть рабочий file_id
+            return
+        file_id = message.photo[-1].file_id
+        self._entries[key] = (mtime_ns, size, file_id)
+        await get_write_queue().put(
+            "INSERT INTO telegram_files (bot_id, directory, filename, mtime_ns, size, file_id, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(bot_id, directory, filename) DO UPDATE SET "
+            "mtime_ns = excluded.mtime_ns, size = excluded.size, "
+            "file_id = excluded.file_id, updated_at = excluded.updated_at",
+            (self.bot_id, key[0], key[1], mtime_ns, size, file_id, datetime.now().isoformat())
+        )
+
+
+file_id_cache = FileIdCache()
+
+
+async def warm_up(bot, chat_id: int, paths: list, concurrency: int = 4):
+    """Предзагрузка картинок в служебный чат, чтобы у всех карт заранее были file_id.
+
+    Уже закэшированные картинки пропускаются; одновременно загружается не больше concurrency файлов.
+    Отправленные сообщения сразу удаляются из служебного чата.
+    """
+    pending = [path for path in paths if os.path.exists(path) and file_id_cache.get_file_id(path) is None]
+    skipped = len(paths) - len(pending)
+    logger.info(f"Предзагрузка картинок: нужно загрузить {len(pending)}, уже в кэше {skipped}")
+    if not pending:
+        return 0
+    
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    done = 0
+    failed = 0
+    
+    async def upload(path):
+        nonlocal done, failed
+        async with semaphore:
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=FSInputFile(path), disable_notification=True)
+                await file_id_cache.remember(path, message)
+            except Exception as e:
+                failed += 1
+                logger.error(f"Ошибка при предзагрузке {path}: {e}")
+                return
+            done += 1
+            logger.info(f"Предзагрузка картинок: {done + failed}/{len(pending)} ({path})")
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            except Exception as e:
+                logger.warning(f"Не удалось удалить сообщение предзагрузки: {e}")
+    
+    await asyncio.gather(*(upload(path) for path in pending))
+    logger.info(f"Предзагрузка картинок завершена: загружено {done}, ошибок {failed}")
+    return done
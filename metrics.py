@@ -0,0 +1,264 @@
+import time
+import bisect
+import logging
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from config import METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, с
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Квантили, которые считаются по гистограммам при выдаче /metrics
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Гистограмма задержек с фиксированными корзинами (как histogram в Prometheus)"""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        # Последняя корзина — все, что больше последней границы (+Inf)
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины (как histogram_quantile)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if index == len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[-1]
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                return lower + (LATENCY_BUCKETS[index] - lower) * (rank - seen) / count
+            seen += count
+        return LATENCY_BUCKETS[-1]
+
+
+class MetricsRegistry:
+    """Счетчики, гистограммы и показатели, вычисляемые при выдаче.
+
+    Метрика адресуется именем и кортежем пар (метка, значение); все операции синхронные
+    и выполняются в цикле событий без блокировок.
+    """
+
+    def __init__(self):
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._gauge_callbacks = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name: str, value: float, labels: tuple = ()):
+        """Изменение текущего значения показателя (например, обновлений в обработке)"""
+        key = (name, labels)
+        self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge_callback(self, name: str, callback: Callable[[], float], kind: str = "gauge"):
+        """Показатель, значение которого берется из callback() в момент выдачи.
+
+        kind="counter" — для счетчиков, которые ведет сам компонент (только растут).
+        """
+        self._gauge_callbacks[name] = (kind, callback)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def _header(self, lines: list, name: str, kind: str):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def render(self) -> str:
+        """Текст в формате Prometheus"""
+        lines = []
+
+        for kind, values in (("counter", self._counters), ("gauge", self._gauges)):
+            for name in sorted({name for name, _ in values}):
+                self._header(lines, name, kind)
+                for (metric, labels), value in values.items():
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+
+        for name, (kind, callback) in self._gauge_callbacks.items():
+            try:
+                value = callback()
+            except Exception as e:
+                logger.warning(f"Не удалось получить метрику {name}: {e}")
+                continue
+            self._header(lines, name, kind)
+            lines.append(f"{name} {value}")
+
+        for name in sorted({name for name, _ in self._histograms}):
+            self._header(lines, name, "histogram")
+            quantile_lines = []
+            for (metric, labels), histogram in self._histograms.items():
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+                for q in QUANTILES:
+                    quantile_lines.append(
+                        f"{name}_quantile{self._labels(labels, (('quantile', q),))} {histogram.quantile(q):.6f}"
+                    )
+            # Оценки p50/p95/p99 по тем же корзинам, чтобы смотреть их без Prometheus
+            lines.append(f"# TYPE {name}_quantile gauge")
+            lines.extend(quantile_lines)
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("bot_updates_in_flight", "Обновления в обработке")
+metrics.describe("bot_update_duration_seconds", "Время обработки обновления")
+metrics.describe("bot_update_errors_total", "Обновления, завершившиеся ошибкой")
+metrics.describe("bot_handler_duration_seconds", "Время работы обработчика")
+metrics.describe("bot_handler_errors_total", "Ошибки в обработчиках")
+metrics.describe("bot_db_duration_seconds", "Время вызовов database.py")
+metrics.describe("bot_db_errors_total", "Ошибки в вызовах database.py")
+metrics.describe("bot_api_duration_seconds", "Время запросов к Bot API")
+metrics.describe("bot_api_errors_total", "Ошибки запросов к Bot API")
+
+
+def timed_db(func):
+    """Замер времени вызова функции database.py; при выключенных метриках функция не оборачивается"""
+    if not METRICS_ENABLED:
+        return func
+    labels = (("call", func.__name__),)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc("bot_db_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_db_duration_seconds", labels, time.perf_counter() - started)
+    return wrapper
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Время обработки каждого обновления и число обновлений в обработке"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        labels = (("type", event.event_type),)
+        metrics.add("bot_updates_in_flight", 1)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_update_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_update_duration_seconds", labels, time.perf_counter() - started)
+            metrics.add("bot_updates_in_flight", -1)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы обработчика по имени обработчика и состоянию FSM"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        callback = data["handler"].callback
+        labels = (
+            ("handler", f"{callback.__module__}.{callback.__name__}"),
+            ("state", data.get("raw_state") or ""),
+        )
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels[:1])
+            raise
+        finally:
+            metrics.observe("bot_handler_duration_seconds", labels, time.perf_counter() - started)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API по методу"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", (("method", name), ("error", type(e).__name__)))
+            raise
+        finally:
+            metrics.observe("bot_api_duration_seconds", (("method", name),), time.perf_counter() - started)
+
+
+def instrument_dispatcher(dp):
+    """Подключение замеров к диспетчеру; внутренние middleware диспетчера действуют на все роутеры"""
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    handler_metrics = HandlerMetricsMiddleware()
+    for event_name, observer in dp.observers.items():
+        if event_name not in ("update", "error"):
+            observer.middleware(handler_metrics)
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    """HTTP-сервер с /metrics; возвращает runner для остановки (runner.cleanup())"""
+    async def handle(request: web.Request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,94 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from config import CALLBACK_DEDUP_WINDOW
+
+logger = logging.getLogger(__name__)
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """Последовательная обработка обновлений одного пользователя.
+
+    Обновления разных пользователей обрабатываются параллельно, а обновления одного ждут друг друга,
+    поэтому обработчики не читают устаревшие данные FSM, пока предыдущий их еще не сохранил.
+    Блокировка существует, только пока у пользователя есть обновления в обработке.
+    """
+
+    def __init__(self):
+        # user_id -> [блокировка, сколько обновлений ее ждут или держат]
+        self._locks = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+
+
+class CallbackDedupMiddleware(BaseMiddleware):
+    """Отбрасывание повторных нажатий одной и той же кнопки.
+
+    Нажатие с теми же callback_data на том же сообщении в течение window секунд считается
+    повтором (двойной тап): на него сразу отвечается answerCallbackQuery, а обработчик не вызывается.
+    Кнопки с префиксами из exempt_prefixes (перелистывание) не проверяются: там каждое нажатие значимо.
+    """
+
+    def __init__(self, window: float = CALLBACK_DEDUP_WINDOW, exempt_prefixes: tuple = ()):
+        self.window = window
+        self.exempt_prefixes = tuple(exempt_prefixes)
+        # (user_id, message_id, callback_data) -> время последнего нажатия, от старых к новым
+        self._seen = OrderedDict()
+        self.dropped = 0
+
+    def _is_duplicate(self, key: tuple) -> bool:
+        now = time.monotonic()
+        while self._seen:
+            oldest_key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.window:
+                break
+            del self._seen[oldest_key]
+
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        return False
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        callback = event.callback_query
+        if callback is None or not self.window or (callback.data or "").startswith(self.exempt_prefixes):
+            return await handler(event, data)
+
+        message_id = callback.message.message_id if callback.message else callback.inline_message_id
+        if self._is_duplicate((callback.from_user.id, message_id, callback.data)):
+            self.dropped += 1
+            try:
+                await data["bot"].answer_callback_query(callback.id)
+            except Exception as e:
+                logger.warning(f"Не удалось ответить на повторное нажатие: {e}")
+            return None
+        return await handler(event, data)
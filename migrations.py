@@ -0,0 +1,178 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+async def backfill_funnel_counters(db):
+    """Заполнение funnel_counters и funnel_totals по событиям из funnel_stats (таблицы должны быть пустыми)"""
+    await db.execute("""
+        INSERT INTO funnel_counters (step, day, count)
+        SELECT step, substr(created_at, 1, 10), COUNT(*)
+        FROM funnel_stats
+        GROUP BY step, substr(created_at, 1, 10)
+    """)
+    await db.execute("""
+        INSERT INTO funnel_totals (step, count)
+        SELECT step, COUNT(*)
+        FROM funnel_stats
+        GROUP BY step
+    """)
+
+
+# Миграции схемы: (версия, описание, шаги). Шаг — SQL-запрос или async-функция, принимающая соединение.
+# Уже выпущенные миграции не изменяются: новая миграция всегда добавляется в конец списка.
+MIGRATIONS = [
+    (1, "базовые таблицы", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            name TEXT,
+            request TEXT,
+            dice_result INTEGER,
+            card_1 TEXT,
+            card_2 TEXT,
+            gift_card_1 TEXT,
+            gift_card_2 TEXT,
+            answers TEXT,
+            instagram_nick TEXT,
+            discount_claimed INTEGER DEFAULT 0,
+            created_at TEXT,
+            updated_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_answers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            question_number INTEGER,
+            answer TEXT,
+            created_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS funnel_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            step TEXT,
+            created_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """,
+    ]),
+    (2, "счетчики воронки", [
+        """
+        CREATE TABLE IF NOT EXISTS funnel_counters (
+            step TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (step, day)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS funnel_totals (
+            step TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        # Счетчики для событий, записанных до появления таблиц
+        backfill_funnel_counters,
+    ]),
+    (3, "индексы для выборок по пользователю и дате", [
+        "CREATE INDEX IF NOT EXISTS idx_user_answers_user_id ON user_answers (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_funnel_stats_user_step ON funnel_stats (user_id, step)",
+        "CREATE INDEX IF NOT EXISTS idx_funnel_stats_created_at ON funnel_stats (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at, user_id)",
+    ]),
+    (4, "частичный индекс для подсчета полученных скидок", [
+        "CREATE INDEX IF NOT EXISTS idx_users_discount_claimed ON users (discount_claimed) WHERE discount_claimed = 1",
+    ]),
+    (5, "кэш file_id загруженных изображений", [
+        """
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            bot_id INTEGER NOT NULL,
+            directory TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at TEXT,
+            PRIMARY KEY (bot_id, directory, filename)
+        )
+        """,
+    ]),
+    (6, "хранилище состояний FSM", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated_at ON fsm_sessions (updated_at)",
+    ]),
+    (7, "отложенные задачи планировщика", [
+        """
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            key TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            run_at REAL NOT NULL,
+            payload TEXT
+        )
+        """,
+    ]),
+]
+
+
+async def get_schema_version(db) -> int:
+    """Текущая версия схемы базы данных"""
+    async with db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version") as cursor:
+        (version,) = await cursor.fetchone()
+    return version
+
+
+async def apply_migrations(db) -> int:
+    """Применение всех еще не примененных миграций по порядку"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
+        )
+    """)
+    await db.commit()
+    
+    version = await get_schema_version(db)
+    for migration_version, description, steps in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        
+        # Каждая миграция — отдельная транзакция. IMMEDIATE сразу берет блокировку записи,
+        # поэтому два процесса, стартующих одновременно, не применят одну миграцию дважды.
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            if await get_schema_version(db) >= migration_version:
+                await db.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            await db.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (migration_version, description, datetime.now().isoformat())
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            logger.exception(f"Ошибка при применении миграции {migration_version} ({description})")
+            raise
+        version = migration_version
+        logger.info(f"Применена миграция {migration_version}: {description}")
+    
+    return version
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from config import PAGINATION_DEBOUNCE
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingPage:
+    __slots__ = ("target", "render", "task")
+
+    def __init__(self, target: int, render):
+        self.target = target
+        self.render = render
+        self.task = None
+
+
+class PageCoalescer:
+    """Объединение быстрых перелистываний одного сообщения.
+
+    Первое нажатие отрисовывается сразу. Нажатия, пришедшие во время отрисовки, только сдвигают
+    целевой номер страницы; после отрисовки и паузы debounce показывается последняя запрошенная
+    страница, а промежуточные не отрисовываются вовсе. Пять быстрых нажатий «Следующая»
+    дают одну-две правки сообщения вместо пяти.
+    """
+
+    def __init__(self, debounce: float = PAGINATION_DEBOUNCE):
+        self.debounce = debounce
+        # (chat_id, message_id) -> ожидающая отрисовка
+        self._pending = {}
+        self.coalesced = 0
+
+    def target(self, key: tuple):
+        """Страница, которая будет показана в сообщении (None, если отрисовок не ожидается)"""
+        pending = self._pending.get(key)
+        return pending.target if pending else None
+
+    def request(self, key: tuple, index: int, render):
+        """Запрос показа страницы index; render(index) — корутина отрисовки"""
+        pending = self._pending.get(key)
+        if pending is not None:
+            # Предыдущая запрошенная страница так и не будет показана
+            self.coalesced += 1
+            pending.target = index
+            pending.render = render
+            return
+        pending = self._pending[key] = _PendingPage(index, render)
+        pending.task = asyncio.create_task(self._run(key, pending))
+
+    async def _run(self, key: tuple, pending: _PendingPage):
+        rendered = None
+        try:
+            while True:
+                if rendered is not None and self.debounce:
+                    # Ждем, не придут ли еще нажатия, чтобы показать сразу последнюю страницу
+                    await asyncio.sleep(self.debounce)
+                if pending.target == rendered:
+                    break
+                index = pending.target
+                await pending.render(index)
+                rendered = index
+        except Exception as e:
+            logger.error(f"Ошибка при перелистывании {key}: {e}")
+        finally:
+            del self._pending[key]
+
+
+page_coalescer = PageCoalescer()
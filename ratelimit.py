@@ -0,0 +1,173 @@
+import time
+import random
+import asyncio
+import logging
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from config import (
+    RATE_LIMIT_GLOBAL, RATE_LIMIT_CHAT, RATE_LIMIT_CHAT_BURST, RATE_LIMIT_GROUP,
+    RATE_LIMIT_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# После скольких созданных корзин чатов удалять простаивающие
+BUCKET_PRUNE_EVERY = 10000
+# Методы, которые создают сообщения в чате и расходуют лимит чата (кроме send*)
+CHAT_SEND_METHODS = {"CopyMessage", "CopyMessages", "ForwardMessage", "ForwardMessages"}
+
+
+def is_send_method(method: TelegramMethod) -> bool:
+    """Создает ли метод новое сообщение в чате (правки и удаления лимит чата не расходуют)"""
+    name = type(method).__name__
+    return name.startswith("Send") or name in CHAT_SEND_METHODS
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+
+    reserve() забирает токен сразу и возвращает, сколько секунд нужно подождать до его появления,
+    поэтому одновременные запросы выстраиваются в очередь без блокировок.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (после RetryAfter)"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Ограничение исходящих запросов к Bot API.
+
+    Запросы, адресованные чату (с полем chat_id), проходят через общую корзину бота, а отправка
+    новых сообщений еще и через корзину чата: для личных чатов RATE_LIMIT_CHAT сообщений в секунду,
+    для групп RATE_LIMIT_GROUP в минуту.
+    Если Telegram все же отвечает RetryAfter, запрос повторяется после указанной паузы со случайной
+    добавкой, а чат приостанавливается на это время для остальных запросов.
+    """
+
+    def __init__(self, global_rate: float = RATE_LIMIT_GLOBAL, chat_rate: float = RATE_LIMIT_CHAT,
+                 chat_burst: int = RATE_LIMIT_CHAT_BURST, group_rate: float = RATE_LIMIT_GROUP / 60,
+                 max_retries: int = RATE_LIMIT_MAX_RETRIES):
+        # Без запаса: запас в rate токенов дал бы до 2 * rate запросов за одну секунду
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chats = {}
+        self._created = 0
+        # Метрики очереди
+        self.waiting = 0
+        self.max_waiting = 0
+        self.delayed = 0
+        self.retries = 0
+        self.failed = 0
+
+    def set_global_rate(self, rate: float):
+        """Изменение общего лимита (когда бот работает в нескольких процессах)"""
+        self.global_bucket = TokenBucket(rate, 1)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            else:
+                # Группы, каналы и @username
+                bucket = TokenBucket(self.group_rate, 1)
+            self._chats[chat_id] = bucket
+            self._created += 1
+            if self._created % BUCKET_PRUNE_EVERY == 0:
+                self._prune()
+        return bucket
+
+    def _prune(self):
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.idle()]:
+            del self._chats[chat_id]
+
+    async def _wait(self, bucket: TokenBucket) -> bool:
+        delay = bucket.reserve()
+        if delay <= 0:
+            return False
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+        return True
+
+    async def _acquire(self, chat_id, send: bool):
+        # Общий токен берется только после ожидания очереди чата, иначе он пропадает,
+        # пока запрос ждет чат, и за одну секунду уходит больше global_rate запросов
+        delayed = send and await self._wait(self._chat_bucket(chat_id))
+        if await self._wait(self.global_bucket) or delayed:
+            self.delayed += 1
+
+    @property
+    def stats(self) -> dict:
+        """Метрики очереди отправки"""
+        return {
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "delayed": self.delayed,
+            "retries": self.retries,
+            "failed": self.failed,
+            "chats": len(self._chats),
+        }
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        send = is_send_method(method)
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._acquire(chat_id, send)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                if chat_id is not None and send:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                delay = e.retry_after + random.uniform(0, 1)
+                logger.warning(
+                    f"Flood control для {type(method).__name__} (чат {chat_id}), "
+                    f"повтор {attempt}/{self.max_retries} через {delay:.1f} с"
+                )
+                if chat_id is not None and send:
+                    # Токен после паузы берется заново в _acquire
+                    await asyncio.sleep(random.uniform(0, 1))
+                else:
+                    await asyncio.sleep(delay)
+
+
+rate_limiter = RateLimitMiddleware()
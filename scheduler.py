@@ -0,0 +1,233 @@
+import json
+import time
+import heapq
+import asyncio
+import logging
+from config import SCHEDULER_CONCURRENCY
+from database import get_pool, get_write_queue
+
+logger = logging.getLogger(__name__)
+
+# Куча перестраивается, когда устаревших записей в ней больше, чем действующих (и не меньше этого числа)
+HEAP_COMPACT_MIN = 1024
+
+
+class Job:
+    """Запланированное действие"""
+
+    __slots__ = ("key", "run_at", "seq", "name", "payload", "callback", "args")
+
+    def __init__(self, key: tuple, run_at: float, seq: int, name: str = None, payload: dict = None,
+                 callback=None, args: tuple = ()):
+        self.key = key
+        self.run_at = run_at
+        self.seq = seq
+        self.name = name
+        self.payload = payload
+        self.callback = callback
+        self.args = args
+
+    @property
+    def persistent(self) -> bool:
+        return self.callback is None
+
+
+class Scheduler:
+    """Планировщик отложенных действий бота.
+
+    Каждое действие привязано к ключу вида (user_id, имя): повторное планирование с тем же ключом
+    заменяет предыдущее, а cancel/cancel_user отменяют действия пользователя.
+    Ожидающие действия — записи в куче по времени запуска, которую обслуживает одна фоновая задача,
+    поэтому сотни тысяч таймеров стоят только памяти под эти записи.
+
+    Действия бывают двух видов:
+    - call_later — корутина с аргументами, живет только в памяти процесса;
+    - schedule — именованная задача с JSON-данными, сохраняется в таблицу scheduled_jobs
+      и переживает перезапуск. Обработчик регистрируется декоратором @scheduler.job(имя)
+      и вызывается как handler(bot, storage, user_id, payload).
+    """
+
+    def __init__(self, concurrency: int = SCHEDULER_CONCURRENCY):
+        self.bot = None
+        self.storage = None
+        self._handlers = {}
+        self._jobs = {}
+        # user_id -> ключи его действий, чтобы cancel_user не перебирал все действия
+        self._user_keys = {}
+        self._heap = []
+        self._seq = 0
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._wakeup = asyncio.Event()
+        self._runner = None
+        self._tasks = set()
+
+    def job(self, name: str):
+        """Регистрация обработчика сохраняемой задачи"""
+        def decorator(handler):
+            self._handlers[name] = handler
+            return handler
+        return decorator
+
+    @staticmethod
+    def _db_key(key: tuple) -> str:
+        return f"{key[0]}:{key[1]}"
+
+    def _push(self, job: Job):
+        self._jobs[job.key] = job
+        self._user_keys.setdefault(job.key[0], set()).add(job.key)
+        # Замененная запись остается в куче и пропускается при извлечении (сверка по seq)
+        heapq.heappush(self._heap, (job.run_at, job.seq, job.key))
+        if self._heap[0][1] == job.seq:
+            self._wakeup.set()
+        self._compact()
+        self._ensure_runner()
+
+    def _pop(self, key: tuple):
+        job = self._jobs.pop(key, None)
+        if job is not None:
+            keys = self._user_keys[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+            self._compact()
+        return job
+
+    def _compact(self):
+        # Отмененные и замененные записи удаляются из кучи лениво; если их накопилось больше,
+        # чем действующих, куча собирается заново только из действующих
+        if len(self._heap) > max(HEAP_COMPACT_MIN, 2 * len(self._jobs)):
+            self._heap = [(job.run_at, job.seq, job.key) for job in self._jobs.values()]
+            heapq.heapify(self._heap)
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def call_later(self, key: tuple, delay: float, callback, *args):
+        """Запуск корутины callback(*args) через delay секунд (только в памяти)"""
+        self.cancel(key)
+        self._push(Job(key, time.time() + delay, self._next_seq(), callback=callback, args=args))
+
+    def schedule(self, name: str, user_id: int, delay: float, payload: dict = None):
+        """Сохраняемая задача name для пользователя через delay секунд"""
+        if name not in self._handlers:
+            raise ValueError(f"Неизвестная задача планировщика: {name}")
+        key = (user_id, name)
+        job = Job(key, time.time() + delay, self._next_seq(), name=name, payload=payload or {})
+        self._push(job)
+        get_write_queue().put_nowait([(
+            "INSERT INTO scheduled_jobs (key, user_id, name, run_at, payload) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET run_at = excluded.run_at, payload = excluded.payload",
+            (self._db_key(key), user_id, name, job.run_at, json.dumps(job.payload, ensure_ascii=False))
+        )])
+
+    def _forget(self, job: Job):
+        if job.persistent:
+            get_write_queue().put_nowait([
+                ("DELETE FROM scheduled_jobs WHERE key = ?", (self._db_key(job.key),))
+            ])
+
+    def cancel(self, key: tuple) -> bool:
+        """Отмена запланированного действия; возвращает True, если оно было"""
+        job = self._pop(key)
+        if job is None:
+            return False
+        self._forget(job)
+        return True
+
+    def cancel_user(self, user_id: int) -> int:
+        """Отмена всех запланированных действий пользователя"""
+        keys = list(self._user_keys.get(user_id, ()))
+        for key in keys:
+            self.cancel(key)
+        return len(keys)
+
+    @property
+    def pending(self) -> int:
+        """Количество запланированных действий"""
+        return len(self._jobs)
+
+    async def start(self, bot, storage, shard: tuple = None):
+        """Подключение бота и хранилища FSM и загрузка сохраненных задач.
+
+        shard=(номер, всего) — загружать только задачи пользователей, обновления которых
+        получает этот процесс (user_id % всего == номер).
+        """
+        self.bot = bot
+        self.storage = storage
+        query = "SELECT user_id, name, run_at, payload FROM scheduled_jobs"
+        params = ()
+        if shard is not None:
+            query += " WHERE user_id % ? = ?"
+            params = (shard[1], shard[0])
+        async with get_pool().reader() as db:
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+        for user_id, name, run_at, payload in rows:
+            key = (user_id, name)
+            if key not in self._jobs:
+                self._push(Job(key, run_at, self._next_seq(), name=name, payload=json.loads(payload or "{}")))
+        logger.info(f"Планировщик запущен, загружено задач: {len(rows)}")
+        self._ensure_runner()
+
+    def _ensure_runner(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap:
+                run_at, seq, key = self._heap[0]
+                job = self._jobs.get(key)
+                if job is None or job.seq != seq:
+                    # Отмененная или замененная запись
+                    heapq.heappop(self._heap)
+                    continue
+                if run_at > now:
+                    break
+                heapq.heappop(self._heap)
+                self._pop(key)
+                task = asyncio.create_task(self._execute(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job: Job):
+        async with self._semaphore:
+            try:
+                if job.persistent:
+                    handler = self._handlers.get(job.name)
+                    if handler is None:
+                        logger.error(f"Нет обработчика для задачи планировщика: {job.name}")
+                    else:
+                        await handler(self.bot, self.storage, job.key[0], job.payload)
+                else:
+                    await job.callback(*job.args)
+            except Exception:
+                logger.exception(f"Ошибка в отложенном действии {job.key}")
+        # Если обработчик запланировал задачу заново, ее запись в БД уже новая
+        if job.key not in self._jobs:
+            self._forget(job)
+
+    async def close(self):
+        """Остановка планировщика; сохраненные задачи выполнятся после перезапуска"""
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._jobs.clear()
+        self._user_keys.clear()
+        self._heap.clear()
+
+
+scheduler = Scheduler()
@@ -0,0 +1,262 @@
+import json
+import time
+import asyncio
+import logging
+from abc import abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from config import FSM_STORAGE, FSM_CACHE_SIZE, FSM_MAX_SESSIONS, FSM_SESSION_TTL, FSM_SWEEP_INTERVAL
+from database import get_pool
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRecord:
+    """Состояние и данные одной сессии FSM"""
+
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None, touched: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.touched = touched
+
+    @property
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+def storage_key(key: StorageKey) -> str:
+    """Компактный строковый ключ сессии"""
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+class SweepingStorage(BaseStorage):
+    """Основа хранилищ с периодической чисткой устаревших сессий в фоне"""
+
+    _sweeper = None
+
+    @abstractmethod
+    async def sweep(self) -> int:
+        """Удаление устаревших сессий; возвращает количество удаленных"""
+        pass
+
+    def start_sweeper(self, interval: int = FSM_SWEEP_INTERVAL):
+        """Запуск периодической чистки устаревших сессий"""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop(interval))
+
+    async def _sweep_loop(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка при чистке сессий FSM: {e}")
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+
+class BoundedMemoryStorage(SweepingStorage):
+    """FSM-хранилище в памяти с ограничением по числу сессий и времени бездействия.
+
+    Сессии упорядочены по последнему обращению: при превышении max_sessions вытесняется
+    самая давняя, а сессии без обращений дольше ttl секунд удаляются при чистке.
+    Счетчики evictions/expirations и resident показывают, сколько сессий вытеснено,
+    истекло и сейчас хранится.
+    """
+
+    def __init__(self, max_sessions: int = FSM_MAX_SESSIONS, ttl: int = FSM_SESSION_TTL):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self.evictions = 0
+        self.expirations = 0
+        self._sessions = OrderedDict()
+
+    @property
+    def resident(self) -> int:
+        """Количество сессий в памяти"""
+        return len(self._sessions)
+
+    def _get(self, key: StorageKey) -> Optional[SessionRecord]:
+        record = self._sessions.get(key)
+        if record is None:
+            return None
+        now = time.monotonic()
+        if self.ttl > 0 and now - record.touched > self.ttl:
+            del self._sessions[key]
+            self.expirations += 1
+            return None
+        record.touched = now
+        self._sessions.move_to_end(key)
+        return record
+
+    def _put(self, key: StorageKey, state: Optional[str], data: dict):
+        record = self._get(key) or SessionRecord()
+        record.state = state
+        record.data = data
+        if record.is_empty:
+            # Пустая сессия (например, после state.clear()) не хранится
+            self._sessions.pop(key, None)
+            return
+        record.touched = time.monotonic()
+        self._sessions[key] = record
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        self._put(key, state.state if isinstance(state, State) else state, record.data if record else {})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._get(key)
+        self._put(key, record.state if record else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return record.data.copy() if record else {}
+
+    async def sweep(self) -> int:
+        if self.ttl <= 0:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        removed = 0
+        # Сессии упорядочены по времени обращения, поэтому устаревшие — в начале
+        while self._sessions:
+            key, record = next(iter(self._sessions.items()))
+            if record.touched >= deadline:
+                break
+            del self._sessions[key]
+            removed += 1
+        self.expirations += removed
+        logger.info(
+            f"Сессии FSM: в памяти {self.resident}, истекло {removed} "
+            f"(всего вытеснено {self.evictions}, истекло {self.expirations})"
+        )
+        return removed
+
+    async def close(self) -> None:
+        await super().close()
+        self._sessions.clear()
+
+
+class SQLiteStorage(SweepingStorage):
+    """FSM-хранилище в SQLite: сессии переживают перезапуск бота.
+
+    Запись сквозная (сначала база, потом кэш), чтение — из LRU-кэша в памяти размером cache_size.
+    Сессии, не менявшиеся дольше ttl секунд, считаются завершенными и удаляются при чистке.
+    """
+
+    def __init__(self, cache_size: int = FSM_CACHE_SIZE, ttl: int = FSM_SESSION_TTL):
+        self.cache_size = max(1, cache_size)
+        self.ttl = ttl
+        self._cache = OrderedDict()
+
+    def _cache_put(self, key: str, record: SessionRecord):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _is_expired(self, record: SessionRecord, now: float) -> bool:
+        return self.ttl > 0 and now - record.touched > self.ttl
+
+    async def _load(self, key: str) -> SessionRecord:
+        now = time.time()
+        record = self._cache.get(key)
+        if record is None:
+            async with get_pool().reader() as db:
+                async with db.execute(
+                    "SELECT state, data, updated_at FROM fsm_sessions WHERE key = ?", (key,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            if row is None:
+                record = SessionRecord(touched=now)
+            else:
+                state, data, updated_at = row
+                record = SessionRecord(state, json.loads(data) if data else {}, updated_at)
+            self._cache_put(key, record)
+        else:
+            self._cache.move_to_end(key)
+        
+        if self._is_expired(record, now):
+            record = SessionRecord(touched=now)
+            self._cache_put(key, record)
+        return record
+
+    async def _save(self, key: str, state: Optional[str], data: dict):
+        now = time.time()
+        async with get_pool().writer() as db:
+            if state is None and not data:
+                # Пустая сессия (например, после state.clear()) не хранится
+                await db.execute("DELETE FROM fsm_sessions WHERE key = ?", (key,))
+            else:
+                await db.execute(
+                    "INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                    "updated_at = excluded.updated_at",
+                    (key, state, json.dumps(data, ensure_ascii=False, separators=(",", ":")), now)
+                )
+            await db.commit()
+        self._cache_put(key, SessionRecord(state, data, now))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = storage_key(key)
+        record = await self._load(k)
+        await self._save(k, state.state if isinstance(state, State) else state, record.data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(storage_key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = storage_key(key)
+        record = await self._load(k)
+        await self._save(k, record.state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(storage_key(key))).data.copy()
+
+    async def sweep(self) -> int:
+        if self.ttl <= 0:
+            return 0
+        deadline = time.time() - self.ttl
+        for key in [key for key, record in self._cache.items() if record.touched < deadline]:
+            del self._cache[key]
+        async with get_pool().writer() as db:
+            cursor = await db.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (deadline,))
+            removed = cursor.rowcount
+            await cursor.close()
+            await db.commit()
+        if removed:
+            logger.info(f"Удалено неактивных сессий FSM: {removed}")
+        return removed
+
+    async def close(self) -> None:
+        await super().close()
+        self._cache.clear()
+
+
+def create_storage(kind: str = FSM_STORAGE) -> BaseStorage:
+    """Создание FSM-хранилища, выбранного в config.FSM_STORAGE"""
+    if kind == "sqlite":
+        storage = SQLiteStorage()
+    elif kind == "memory":
+        return MemoryStorage()
+    else:
+        if kind != "bounded":
+            logger.warning(f"Неизвестное FSM_STORAGE={kind}, используется bounded")
+        storage = BoundedMemoryStorage()
+    storage.start_sweeper()
+    return storage
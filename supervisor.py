@@ -0,0 +1,271 @@
+import json
+import time
+import signal
+import asyncio
+import logging
+import multiprocessing
+from functools import partial
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+from aiogram import Bot
+from aiogram.fsm.storage.memory import MemoryStorage
+from config import (
+    BOT_MODE, WARMUP_CHAT_ID, RATE_LIMIT_GLOBAL, WEBHOOK_PATH, WORKER_HEALTH_TIMEOUT,
+    METRICS_PORT,
+)
+from database import init_db, init_pool, close_pool
+from media_cache import file_id_cache
+from scheduler import scheduler
+from cleanup import wait_pending as wait_pending_cleanup
+from webhook import SECRET_HEADER, webhook_secret, serve_webhook
+from app import (
+    create_bot, create_dispatcher, prepare_catalogs, warm_up_catalogs, start_metrics, run_until_terminated,
+)
+
+logger = logging.getLogger(__name__)
+
+# Таймаут long polling для getUpdates, с
+POLLING_TIMEOUT = 30
+# Как часто рабочий процесс сообщает, что жив, с
+HEARTBEAT_INTERVAL = 1
+# Сколько ждать завершения рабочего процесса при остановке, с
+WORKER_STOP_TIMEOUT = 30
+
+
+def update_user_id(update: dict) -> int:
+    """user_id автора обновления (0, если в обновлении нет пользователя)"""
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat") or {}
+            return user.get("id", 0)
+    return 0
+
+
+# ---------- Рабочий процесс ----------
+
+async def _heartbeat(value, updates):
+    parent = multiprocessing.parent_process()
+    while True:
+        if not parent.is_alive():
+            # Распределитель завершился, не остановив рабочих: без него процесс отправлял бы
+            # напоминания своей доли и держал порт метрик, поэтому останавливаемся сами
+            logger.error("Распределитель завершился, остановка рабочего процесса")
+            updates.put(None)
+            return
+        value.value = time.time()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+async def _process_update(dp, bot, update: dict, previous: asyncio.Task):
+    # Обновления одного пользователя обрабатываются строго по очереди
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception:
+        logger.exception(f"Ошибка при обработке обновления {update.get('update_id')}")
+
+
+def _release(tails: dict, user_id: int, task: asyncio.Task):
+    if tails.get(user_id) is task:
+        del tails[user_id]
+
+
+async def run_worker(index: int, count: int, updates, heartbeat):
+    """Рабочий процесс: обрабатывает обновления пользователей с user_id % count == index"""
+    await init_pool()
+
+    # Общий лимит отправки делится между процессами; чат всегда обслуживает один процесс
+    bot = create_bot(global_rate=RATE_LIMIT_GLOBAL / count)
+    dp = create_dispatcher()
+    catalog_watcher = await prepare_catalogs(image_workers=1)
+    await file_id_cache.load(bot.id)
+    await scheduler.start(bot, dp.storage, shard=(index, count))
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    metrics_runner = await start_metrics(dp, port=METRICS_PORT + index)
+    beat = asyncio.create_task(_heartbeat(heartbeat, updates))
+    logger.info(f"Рабочий процесс {index} запущен")
+
+    loop = asyncio.get_running_loop()
+    tails = {}
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            user_id = update_user_id(update)
+            task = asyncio.create_task(_process_update(dp, bot, update, tails.get(user_id)))
+            tails[user_id] = task
+            task.add_done_callback(partial(_release, tails, user_id))
+    finally:
+        if tails:
+            await asyncio.wait(list(tails.values()))
+        beat.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        catalog_watcher.cancel()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await scheduler.close()
+        await wait_pending_cleanup()
+        await dp.storage.close()
+        await bot.session.close()
+        await close_pool()
+        logger.info(f"Рабочий процесс {index} остановлен")
+
+
+def worker_process(index: int, count: int, updates, heartbeat):
+    """Точка входа рабочего процесса"""
+    # Ctrl+C получает вся группа процессов; останавливает рабочих распределитель
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker{index} - %(name)s - %(levelname)s - %(message)s',
+        force=True
+    )
+    asyncio.run(run_worker(index, count, updates, heartbeat))
+
+
+# ---------- Распределитель ----------
+
+class WorkerSlot:
+    """Рабочий процесс с его очередью обновлений и отметкой последнего сигнала"""
+
+    def __init__(self, context, index: int, count: int):
+        self.context = context
+        self.index = index
+        self.count = count
+        self.process = None
+        self.updates = None
+        self.heartbeat = None
+
+    def start(self):
+        # Очередь создается заново: аварийно завершенный процесс мог оставить ее блокировку занятой
+        self.updates = self.context.Queue()
+        self.heartbeat = self.context.Value("d", 0.0, lock=False)
+        self.process = self.context.Process(
+            target=worker_process,
+            args=(self.index, self.count, self.updates, self.heartbeat),
+            name=f"worker{self.index}",
+        )
+        self.process.start()
+
+    def restart(self, reason: str):
+        try:
+            lost = self.updates.qsize()
+        except NotImplementedError:
+            # qsize() недоступен на macOS
+            lost = "?"
+        logger.error(f"Рабочий процесс {self.index} {reason}, перезапуск (потеряно обновлений: {lost})")
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.start()
+
+    def stop(self):
+        self.updates.put(None)
+        self.process.join(WORKER_STOP_TIMEOUT)
+        if self.process.is_alive():
+            logger.warning(f"Рабочий процесс {self.index} не завершился вовремя, принудительная остановка")
+            self.process.terminate()
+            self.process.join()
+
+
+async def _monitor(slots: list):
+    """Перезапуск завершившихся и зависших рабочих процессов"""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        now = time.time()
+        for slot in slots:
+            if not slot.process.is_alive():
+                await asyncio.to_thread(slot.restart, f"завершился с кодом {slot.process.exitcode}")
+            # Пока процесс запускается, отметки еще нет
+            elif slot.heartbeat.value and now - slot.heartbeat.value > WORKER_HEALTH_TIMEOUT:
+                await asyncio.to_thread(slot.restart, f"не отвечает {now - slot.heartbeat.value:.0f} с")
+
+
+async def _poll_updates(bot: Bot, dispatch, allowed_updates: list):
+    """Long polling без разбора обновлений в модели: только JSON и передача рабочему"""
+    url = bot.session.api.api_url(token=bot.token, method="getUpdates")
+    offset = None
+    async with ClientSession(timeout=ClientTimeout(total=POLLING_TIMEOUT + 10)) as session:
+        while True:
+            params = {"timeout": POLLING_TIMEOUT, "allowed_updates": json.dumps(allowed_updates)}
+            if offset is not None:
+                params["offset"] = offset
+            try:
+                async with session.post(url, data=params) as response:
+                    result = await response.json()
+            except (ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            if not result.get("ok"):
+                logger.warning(f"getUpdates вернул ошибку: {result.get('description')}")
+                await asyncio.sleep(result.get("parameters", {}).get("retry_after", 1))
+                continue
+
+            for update in result["result"]:
+                offset = update["update_id"] + 1
+                dispatch(update)
+
+
+def _create_ingress_app(bot: Bot, dispatch) -> web.Application:
+    """Webhook распределителя: проверка секрета, передача рабочему и сразу ответ 200"""
+    secret = webhook_secret(bot)
+
+    async def handle(request: web.Request):
+        if request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=401)
+        dispatch(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    return app
+
+
+async def run_supervisor(count: int):
+    """Распределитель: один прием обновлений, count рабочих процессов.
+
+    Обновление передается процессу user_id % count, поэтому все обновления пользователя
+    обрабатывает один процесс по порядку, а его состояние FSM и напоминания живут только там.
+    """
+    # Миграции, оптимизация и предзагрузка картинок выполняются один раз до запуска рабочих
+    await init_pool()
+    await init_db()
+    bot = create_bot()
+    catalog_watcher = await prepare_catalogs()
+    catalog_watcher.cancel()
+    if WARMUP_CHAT_ID:
+        await file_id_cache.load(bot.id)
+        await warm_up_catalogs(bot)
+    await close_pool()
+
+    allowed_updates = create_dispatcher(MemoryStorage()).resolve_used_update_types()
+
+    context = multiprocessing.get_context("spawn")
+    slots = [WorkerSlot(context, index, count) for index in range(count)]
+    for slot in slots:
+        slot.start()
+    monitor = asyncio.create_task(_monitor(slots))
+
+    def dispatch(update: dict):
+        slots[update_user_id(update) % count].updates.put(update)
+
+    async def ingress():
+        if BOT_MODE == "webhook":
+            await serve_webhook(_create_ingress_app(bot, dispatch), bot, allowed_updates)
+        else:
+            # Webhook и getUpdates не работают одновременно
+            await bot.delete_webhook()
+            await _poll_updates(bot, dispatch, allowed_updates)
+
+    logger.info(f"Бот запущен ({BOT_MODE}, рабочих процессов: {count})")
+
+    try:
+        # SIGTERM (systemd, docker stop) останавливает прием обновлений, а затем и рабочих, как Ctrl+C
+        await run_until_terminated(ingress())
+    finally:
+        monitor.cancel()
+        await asyncio.gather(*(asyncio.to_thread(slot.stop) for slot in slots))
+        await bot.session.close()
@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+import logging
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram присылает секрет webhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_secret(bot: Bot) -> str:
+    """Секрет webhook: из настроек или производный от токена (одинаковый во всех процессах)"""
+    return WEBHOOK_SECRET or hashlib.sha256(bot.token.encode()).hexdigest()[:32]
+
+
+def create_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """aiohttp-приложение, принимающее обновления от Telegram.
+
+    Запрос без правильного секрета отклоняется. Обновление сразу подтверждается ответом 200,
+    а обрабатывается в фоновой задаче, чтобы Telegram не ждал обработчиков.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=webhook_secret(bot),
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def serve_webhook(app: web.Application, bot: Bot, allowed_updates: list, set_webhook: bool = True):
+    """Запуск HTTP-сервера с приложением app и регистрация webhook; работает до отмены"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужно указать WEBHOOK_URL")
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        if set_webhook:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=webhook_secret(bot),
+                allowed_updates=allowed_updates,
+            )
+            logger.info(f"Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, set_webhook: bool = True):
+    """Прием обновлений через webhook с обработкой в этом процессе"""
+    await serve_webhook(create_app(dp, bot), bot, dp.resolve_used_update_types(), set_webhook)